@@ -0,0 +1,207 @@
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+
+from utils import downloader, extractor
+from utils.scheduler import DeadlineScheduler
+from utils.messages import MessageScheduler
+
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL, answers `extract_info` with made up metadata after `latency` seconds.
+
+    Urls starting with "playlist:" are playlists of `playlist_size` entries,
+    honouring the `playlist_items` param like the flat extractor does.
+    """
+    def __init__(self, latency: float = 0.05, playlist_size: int = 200):
+        self.latency = latency
+        self.playlist_size = playlist_size
+        self.params = {}
+
+    @staticmethod
+    def track(url: str):
+        video_id = hashlib.sha1(url.encode()).hexdigest()[:11]
+        webpage_url = url if url.startswith("https://") else f"https://www.youtube.com/watch?v={video_id}"
+        return {"id": video_id,
+                "title": f"Track {video_id}",
+                "url": f"https://media.invalid/{video_id}.webm?expire={int(time.time())+6*60*60}",
+                "webpage_url": webpage_url,
+                "uploader": "Fake Uploader",
+                "duration": 180,
+                "view_count": 123456,
+                "like_count": 1234,
+                "thumbnail": f"https://media.invalid/{video_id}.jpg",
+                "acodec": "opus"}
+
+    def extract_info(self, url: str, download: bool = False):
+        time.sleep(self.latency)
+        if not url.startswith("playlist:"):
+            return self.track(url)
+        start, _, end = self.params.get("playlist_items", f"1:{self.playlist_size}").partition(":")
+        items = range(int(start), min(int(end), self.playlist_size)+1)
+        return {"title": url, "entries": [self.track(f"{url}/{item}") for item in items]}
+
+    def prepare_filename(self, data: dict):
+        return f"{data['id']}.webm"
+
+
+def install_fake_extractor(latency: float, workers: int = 2):
+    """Routes the extraction engine to FakeYoutubeDL instances on a thread pool of `workers`.
+
+    The real `_extract` functions still run, so field filtering and the
+    engine's in-flight limit are part of the measurement."""
+    extractor._worker_ytdl = FakeYoutubeDL(latency)
+    extractor._worker_flat_ytdl = FakeYoutubeDL(latency)
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="fake-extractor")
+    downloader.engine.configure(workers=workers)
+    downloader.admission.slots = downloader.engine.max_in_flight
+    downloader.engine.max_tasks_per_pool = float("inf")
+    downloader.engine.start = lambda: pool
+    return pool
+
+
+class FakeAudio(discord.AudioSource):
+    "Stands in for the FFmpeg sources, spawning takes `spawn_latency` and every read returns a silent frame"
+    spawn_latency = 0.005
+
+    def __init__(self, source, *args, codec: str | None = None, **kwargs):
+        time.sleep(self.spawn_latency)
+        self.opus = codec is not None
+
+    def read(self):
+        return b"\xf8\xff\xfe" if self.opus else b"\x00"*discord.opus.Encoder.FRAME_SIZE
+
+    def is_opus(self):
+        return self.opus
+
+    def cleanup(self):
+        pass
+
+
+def install_fake_ffmpeg(spawn_latency: float):
+    FakeAudio.spawn_latency = spawn_latency
+    discord.FFmpegPCMAudio = FakeAudio
+    discord.FFmpegOpusAudio = FakeAudio
+
+
+class FakeVoiceClient:
+    """Plays every source for `track_seconds`, then calls `after` from a timer thread like the audio player does.
+
+    The time between a track ending and the next `play` is kept in `gaps`."""
+    def __init__(self, track_seconds: float = 0.05):
+        self.track_seconds = track_seconds
+        self.source = None
+        self.gaps: list[float] = []
+        self._after = None
+        self._timer: threading.Timer | None = None
+        self._ended_at: float | None = None
+        self._connected = True
+        self._lock = threading.Lock()
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._timer is not None
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, *, after=None):
+        if self._ended_at is not None:
+            self.gaps.append(time.perf_counter()-self._ended_at)
+        self.source = source
+        self._after = after
+        source.read()
+        self._timer = threading.Timer(self.track_seconds, self._finish)
+        self._timer.start()
+
+    def _finish(self):
+        with self._lock:
+            timer, self._timer = self._timer, None
+            after, self._after = self._after, None
+        if timer is None:
+            return
+        timer.cancel()
+        self._ended_at = time.perf_counter()
+        self.source.cleanup()
+        if after is not None:
+            after(None)
+
+    def stop(self):
+        self._finish()
+
+    async def disconnect(self, *, force: bool = False):
+        self._connected = False
+        self.stop()
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+
+class FakeMessage:
+    _ids = itertools.count()
+
+    def __init__(self, channel: FakeChannel, send_latency: float):
+        self.id = next(self._ids)
+        self.channel = channel
+        self.send_latency = send_latency
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.send_latency)
+
+
+class FakeAuthor:
+    def __init__(self):
+        self.name = "bench"
+        self.color = discord.Colour.default()
+        # Anything not None counts as being connected to a voice channel
+        self.voice = object()
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, voice_client: FakeVoiceClient):
+        self.id = guild_id
+        self.voice_client = voice_client
+
+
+class FakeContext:
+    "Command context whose `send` takes `send_latency` seconds, like a message round trip to discord"
+    def __init__(self, bot: "FakeBot", guild_id: int, voice_client: FakeVoiceClient, send_latency: float = 0.02):
+        self.bot = bot
+        self.guild = FakeGuild(guild_id, voice_client)
+        self.channel = FakeChannel(guild_id)
+        self.id = guild_id
+        self.voice_client = voice_client
+        self.author = FakeAuthor()
+        self.message = self
+        self.send_latency = send_latency
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+        return FakeMessage(self.channel, self.send_latency)
+
+    def typing(self):
+        return contextlib.nullcontext()
+
+
+class FakeBot:
+    def __init__(self, loop: asyncio.AbstractEventLoop, audio_mode: str = "pcm"):
+        self.loop = loop
+        self.CONFIG = {"AUDIO_MODE": audio_mode}
+        self.SCHEDULER = DeadlineScheduler()
+        self.MESSAGES = MessageScheduler(self.SCHEDULER)
+        self.guilds = []
+
+    def get_guild(self, guild_id: int):
+        return None
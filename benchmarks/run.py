@@ -0,0 +1,199 @@
+"""Offline benchmarks of the music cogs.
+
+yt-dlp, FFmpeg, the voice client and message sending are replaced by the
+fakes in benchmarks.fakes, each with a configurable latency, so runs are
+repeatable and comparable between changes. Results are printed as JSON.
+
+    python -m benchmarks.run --output results.json
+"""
+import asyncio
+import gc
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from benchmarks.fakes import FakeBot, FakeContext, FakeVoiceClient, FakeYoutubeDL, install_fake_extractor, install_fake_ffmpeg
+from cogs.music import MusicQueue, QueueManager
+from utils import downloader
+from utils.downloader import QueueEntry
+
+
+url_counter = 0
+
+
+def unique_urls(count: int):
+    "Fresh urls per call, so the metadata cache does not answer instead of the extractor"
+    global url_counter
+    url_counter += count
+    return [f"https://www.youtube.com/watch?v=bench{number}" for number in range(url_counter-count, url_counter)]
+
+
+def summarize(samples: list[float]):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+    return {"count": len(samples),
+            "mean": statistics.fmean(samples),
+            "p50": samples[len(samples)//2],
+            "p95": samples[min(len(samples)-1, int(len(samples)*0.95))],
+            "max": samples[-1]}
+
+
+async def invoke(cog: MusicQueue, command: str, ctx: FakeContext, **kwargs):
+    "Calls a command's callback directly, the cog is never added to a bot so commands are not bound to it"
+    return await getattr(cog, command).callback(cog, ctx, **kwargs)
+
+
+def guild_context(bot: FakeBot, guild_id: int, args):
+    return FakeContext(bot, guild_id, FakeVoiceClient(args.track_seconds), send_latency=args.send_latency)
+
+
+async def bench_enqueue(cog: MusicQueue, bot: FakeBot, args):
+    "Sequential `enqueue` commands in one guild, then concurrent ones spread over guilds"
+    ctx = guild_context(bot, 1, args)
+    latencies = []
+    started = time.perf_counter()
+    for url in unique_urls(args.enqueue_count):
+        command_started = time.perf_counter()
+        await invoke(cog, 'enqueue', ctx, url=url)
+        latencies.append(time.perf_counter()-command_started)
+    sequential = time.perf_counter()-started
+
+    contexts = [guild_context(bot, 100+guild, args) for guild in range(args.concurrent_guilds)]
+    urls = unique_urls(args.enqueue_count)
+    started = time.perf_counter()
+    await asyncio.gather(*(invoke(cog, 'enqueue', contexts[position%len(contexts)], url=url) for position, url in enumerate(urls)))
+    concurrent = time.perf_counter()-started
+    return {"sequential_per_second": args.enqueue_count/sequential,
+            "sequential_latency": summarize(latencies),
+            "concurrent_guilds": args.concurrent_guilds,
+            "concurrent_per_second": args.enqueue_count/concurrent}
+
+
+async def bench_multi_queue(cog: MusicQueue, bot: FakeBot, args):
+    "Wall time of `multi_queue` with a batch of comma separated urls"
+    durations = []
+    for run in range(args.repeat):
+        ctx = guild_context(bot, 1000+run, args)
+        batch = ", ".join(unique_urls(args.batch_size))
+        started = time.perf_counter()
+        await invoke(cog, 'multi_queue', ctx, url=batch)
+        durations.append(time.perf_counter()-started)
+    return {"batch_size": args.batch_size, "seconds": summarize(durations)}
+
+
+async def bench_pages(cog: MusicQueue, bot: FakeBot, args):
+    "Building the queue pages of a large queue and rendering its first, middle and last page"
+    ctx = guild_context(bot, 2000, args)
+    qm = QueueManager(bot, ctx.voice_client, ctx)
+    qm.queue.max_upcoming = max(qm.queue.max_upcoming, args.page_entries)
+    qm.queue.extend(QueueEntry(FakeYoutubeDL.track(url)) for url in unique_urls(args.page_entries))
+    timings = {}
+    started = time.perf_counter()
+    pages = qm.get_pages()
+    timings["get_pages"] = time.perf_counter()-started
+    for name, page in (("first_page", 0), ("middle_page", len(pages)//2), ("last_page", -1), ("first_page_again", 0)):
+        started = time.perf_counter()
+        pages[page]
+        timings[name] = time.perf_counter()-started
+    return {"entries": args.page_entries, "pages": len(pages), "seconds": timings}
+
+
+async def bench_transitions(cog: MusicQueue, bot: FakeBot, args):
+    "Gaps between the end of a track and the start of the next one during queue playback"
+    ctx = guild_context(bot, 3000, args)
+    qm = QueueManager(bot, ctx.voice_client, ctx, audio_mode=args.audio_mode)
+    for url in unique_urls(args.transition_tracks):
+        await qm.add_from_url(url)
+    started = time.perf_counter()
+    await qm.play(ctx.voice_client)
+    await qm._player_task
+    return {"tracks": args.transition_tracks,
+            "track_seconds": args.track_seconds,
+            "total_seconds": time.perf_counter()-started,
+            "gap_seconds": summarize(ctx.voice_client.gaps)}
+
+
+async def bench_memory(cog: MusicQueue, bot: FakeBot, args):
+    "Traced memory of guilds with a queue manager and a few queued entries each"
+    # The fake discord objects are not part of what is measured
+    contexts = [guild_context(bot, 10000+guild, args) for guild in range(args.memory_guilds)]
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for ctx in contexts:
+        qm = await cog.get_guild_queue_manager(ctx)
+        qm.queue.extend(QueueEntry(FakeYoutubeDL.track(url)) for url in unique_urls(args.memory_entries))
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"guilds": args.memory_guilds,
+            "entries_per_guild": args.memory_entries,
+            "bytes_per_guild": (after-before)/args.memory_guilds,
+            "peak_bytes": peak-before}
+
+
+BENCHMARKS = {"enqueue": bench_enqueue,
+              "multi_queue": bench_multi_queue,
+              "pages": bench_pages,
+              "transitions": bench_transitions,
+              "memory": bench_memory}
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    pool = install_fake_extractor(args.extract_latency, workers=args.workers)
+    install_fake_ffmpeg(args.spawn_latency)
+    bot = FakeBot(loop, audio_mode=args.audio_mode)
+    cog = MusicQueue(bot)
+    results = {}
+    try:
+        for name in args.only or BENCHMARKS:
+            results[name] = await BENCHMARKS[name](cog, bot, args)
+            # Guilds of one benchmark should not weigh on the next
+            for qm in cog.queue_managers.values():
+                qm.reset()
+            cog.queue_managers.clear()
+            downloader.metadata_cache._entries.clear()
+    finally:
+        bot.SCHEDULER.stop()
+        pool.shutdown(wait=False)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Runs the offline music benchmarks and prints the results as JSON")
+    parser.add_argument('--output', help="Also writes the results to this file")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help="Runs only these benchmarks")
+    parser.add_argument('--extract-latency', type=float, default=0.05, help="Seconds a fake extraction takes")
+    parser.add_argument('--spawn-latency', type=float, default=0.005, help="Seconds a fake FFmpeg spawn takes")
+    parser.add_argument('--send-latency', type=float, default=0.02, help="Seconds a fake message send takes")
+    parser.add_argument('--track-seconds', type=float, default=0.05, help="Seconds a fake track plays")
+    parser.add_argument('--workers', type=int, default=2, help="Extraction workers")
+    parser.add_argument('--audio-mode', choices=downloader.AUDIO_MODES, default="pcm")
+    parser.add_argument('--enqueue-count', type=int, default=100)
+    parser.add_argument('--concurrent-guilds', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=25)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--page-entries', type=int, default=10000)
+    parser.add_argument('--transition-tracks', type=int, default=20)
+    parser.add_argument('--memory-guilds', type=int, default=1000)
+    parser.add_argument('--memory-entries', type=int, default=5)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report = {"python": platform.python_version(),
+              "config": {key: value for key, value in vars(args).items() if key not in ("output", "only")},
+              "results": results}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+"\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,164 @@
+import time
+# Taken ahead of the imports below, so the startup report includes them
+IMPORTS_STARTED = time.perf_counter()
+
+import asyncio
+import importlib
 import os
 import sys
+from typing import Optional
 import dotenv
 
 import discord
 from discord.ext import commands
 
-from utils.printer import PrettyPrinter, MultiWritePipe
+from utils.printer import PrettyPrinter, AsyncLogPipe, RotatingFile
+from utils.scheduler import DeadlineScheduler
+from utils.messages import MessageScheduler
+from utils.sessions import session_store
+from utils import downloader
 
 
-class Bot(commands.Bot):
-    def __init__(self, *args, printer=PrettyPrinter(), **options):
+class Bot(commands.AutoShardedBot):
+    def __init__(self, *args, printer=None, config: Optional[dict] = None, deferred_extensions: Optional[list] = None, **options):
         super().__init__(*args, **options)
-        self.PRINTER = printer
+        self.PRINTER = printer if printer is not None else PrettyPrinter()
+        self.CONFIG = config if config is not None else {}
+        # Shared by the cogs for idle disconnects and evictions
+        self.SCHEDULER = DeadlineScheduler()
+        # Sends and edits messages within the per channel rate limits
+        self.MESSAGES = MessageScheduler(self.SCHEDULER)
+        # Set to a ClusterLink when running as a worker of a cluster
+        self.CLUSTER = None
+        # Seconds spent in each startup phase, reported once the bot is ready
+        self.STARTUP = {}
+        self.deferred_extensions = deferred_extensions if deferred_extensions is not None else []
+        self._connect_started = None
+    
+    async def login(self, token: str):
+        started = time.perf_counter()
+        # Deferred cogs are imported on threads while the login request is in flight, and are
+        # registered before the gateway connects, so their application commands still get synced
+        imports = [asyncio.to_thread(importlib.import_module, name) for name in self.deferred_extensions]
+        await asyncio.gather(super().login(token), *imports)
+        self.STARTUP["login"] = time.perf_counter()-started
+        for name in self.deferred_extensions:
+            started = time.perf_counter()
+            self.load_extension(name)
+            self.STARTUP[f"cog {name}"] = time.perf_counter()-started
+        self.loop.create_task(self.warm_up_extractor())
+        if self.CONFIG.get("AUDIO_MODE") == "worker":
+            downloader.voice_pool.start()
+        self._connect_started = time.perf_counter()
+    
+    async def warm_up_extractor(self):
+        started = time.perf_counter()
+        try:
+            await downloader.engine.warm_up()
+        except Exception as exc:
+            self.PRINTER.print_info("Extractor Warm Up Failed", {"error": exc})
+            return
+        self.PRINTER.print_info("Startup", {"extractor warm up": f"{time.perf_counter()-started:.2f}s"})
+    
+    async def on_ready(self):
+        # on_ready fires again after reconnects, the report is only made once
+        if "ready" in self.STARTUP or self._connect_started is None:
+            return
+        self.STARTUP["ready"] = time.perf_counter()-self._connect_started
+        report = {phase: f"{seconds:.2f}s" for phase, seconds in self.STARTUP.items()}
+        report["total"] = f"{time.perf_counter()-IMPORTS_STARTED:.2f}s"
+        self.PRINTER.print_info("Startup", report)
+    
+    async def close(self):
+        self.SCHEDULER.stop()
+        # Sessions are saved while their voice clients are still connected, so they resume playing after a restart
+        music_queue = self.get_cog('MusicQueue')
+        if music_queue is not None and session_store.enabled:
+            session_store.write(*music_queue.collect_snapshots())
+        await super().close()
+        downloader.engine.shutdown()
+        downloader.download_engine.shutdown()
+        downloader.voice_pool.shutdown()
+        if isinstance(self.PRINTER.pipe, AsyncLogPipe):
+            self.PRINTER.pipe.close()
+
+
+def cluster_path(path: str, cluster_id: Optional[int]):
+    "Gives each cluster its own copy of a file, sessions.sqlite3 becomes sessions.cluster-1.sqlite3"
+    if cluster_id is None or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.cluster-{cluster_id}{ext}"
 
 
-def setup(config: dict):
+def setup(config: dict, cluster_id: Optional[int] = None, **options):
     config.setdefault("LOG_FILE", 'logs.log')
+    config.setdefault("LOG_MAX_MB", '10')
+    config.setdefault("LOG_BACKUPS", '3')
+    config.setdefault("LOG_QUEUE_SIZE", '10000')
     config.setdefault("COGS_DIR", 'cogs')
-    try:
-        open(config["LOG_FILE"])
-    except FileNotFoundError:
-        with open(config["LOG_FILE"], 'w') as f:
-            pass
+    # Comma separated cog files loaded while logging in rather than before it
+    config.setdefault("DEFERRED_COGS", '')
+    config.setdefault("METADATA_CACHE_FILE", 'metadata_cache.sqlite3')
+    config.setdefault("EXTRACTOR_WORKERS", '2')
+    config.setdefault("EXTRACTOR_TIMEOUT", '30')
+    # Extractions one guild may run at once, and may have waiting before being turned away
+    config.setdefault("EXTRACTOR_GUILD_CONCURRENCY", '2')
+    config.setdefault("EXTRACTOR_GUILD_QUEUE", '25')
+    # Entries queued from a single playlist at most
+    config.setdefault("PLAYLIST_MAX_ENTRIES", '200')
+    # pcm, or opus and worker to opt into moving the audio work out of the bot process, see downloader.AUDIO_MODES
+    config.setdefault("AUDIO_MODE", 'pcm')
+    # Processes decoding and encoding audio when AUDIO_MODE is worker
+    config.setdefault("VOICE_WORKERS", '2')
+    config.setdefault("AUDIO_CACHE_DIR", '')
+    config.setdefault("AUDIO_CACHE_MAX_MB", '1024')
+    config.setdefault("AUDIO_CACHE_MIN_PLAYS", '3')
+    # Downloads into the audio cache run on their own worker, with this timeout
+    config.setdefault("AUDIO_CACHE_DOWNLOAD_TIMEOUT", '600')
+    # Queues are snapshotted to this file and restored on startup, an empty value disables it
+    config.setdefault("SESSION_FILE", 'sessions.sqlite3')
+    config.setdefault("SESSION_SNAPSHOT_INTERVAL", '30')
+    # Event loop blocks longer than this are sampled and reported by the watchdog
+    config.setdefault("LOOP_BLOCK_THRESHOLD_MS", '100')
+    # Serves the metrics in Prometheus format on localhost when set
+    config.setdefault("METRICS_PORT", '')
+    setup_started = time.perf_counter()
+    # Rotation renames the file under the other clusters' feet, so each writes its own
+    log_file = RotatingFile(cluster_path(config["LOG_FILE"], cluster_id), max_bytes=int(config["LOG_MAX_MB"])*1024*1024, backup_count=int(config["LOG_BACKUPS"]))
+    printer = PrettyPrinter(target_pipe=AsyncLogPipe(log_file, sys.stdout, max_pending=int(config["LOG_QUEUE_SIZE"])))
+    # Errors of the utils and cogs go to the log pipe as well, rather than to stdout on the event loop
+    printer.make_default()
     
-    printer = PrettyPrinter()
-    printer.target_pipe=MultiWritePipe(open(config["LOG_FILE"]), sys.stdout)
+    # The stores are not shared between processes, each cluster keeps its own
+    downloader.metadata_cache.open(cluster_path(config["METADATA_CACHE_FILE"], cluster_id))
+    if config["SESSION_FILE"]:
+        session_store.open(cluster_path(config["SESSION_FILE"], cluster_id))
+    downloader.engine.configure(workers=int(config["EXTRACTOR_WORKERS"]), timeout=float(config["EXTRACTOR_TIMEOUT"]))
+    downloader.admission.slots = downloader.engine.max_in_flight
+    downloader.admission.per_guild = int(config["EXTRACTOR_GUILD_CONCURRENCY"])
+    downloader.admission.max_guild_queue = int(config["EXTRACTOR_GUILD_QUEUE"])
+    downloader.voice_pool.configure(workers=int(config["VOICE_WORKERS"]))
+    if config["AUDIO_CACHE_DIR"]:
+        downloader.audio_cache.max_bytes = int(config["AUDIO_CACHE_MAX_MB"])*1024*1024
+        downloader.audio_cache.min_plays = int(config["AUDIO_CACHE_MIN_PLAYS"])
+        downloader.download_engine.configure(timeout=float(config["AUDIO_CACHE_DOWNLOAD_TIMEOUT"]))
+        audio_cache_dir = config["AUDIO_CACHE_DIR"]
+        if cluster_id is not None:
+            audio_cache_dir = os.path.join(audio_cache_dir, f"cluster-{cluster_id}")
+        downloader.audio_cache.open(audio_cache_dir)
     
     intents = discord.Intents.default()
     intents.message_content = True
-    bot = Bot(command_prefix=commands.when_mentioned_or("~"), intents=intents, printer=printer)
-    for _file in os.listdir(config["COGS_DIR"]):
-        if _file.endswith(".py"):
-            bot.load_extension(f"{config['COGS_DIR']}.{_file[:-3]}")
+    deferred = {name.strip() for name in config["DEFERRED_COGS"].split(",") if name.strip()}
+    extensions = [f"{config['COGS_DIR']}.{_file[:-3]}" for _file in sorted(os.listdir(config["COGS_DIR"])) if _file.endswith(".py")]
+    bot = Bot(command_prefix=commands.when_mentioned_or("~"), intents=intents, printer=printer, config=config,
+              deferred_extensions=[name for name in extensions if name.rpartition(".")[2] in deferred], **options)
+    bot.STARTUP["imports"] = setup_started-IMPORTS_STARTED
+    bot.STARTUP["setup"] = time.perf_counter()-setup_started
+    for name in extensions:
+        if name not in bot.deferred_extensions:
+            started = time.perf_counter()
+            bot.load_extension(name)
+            bot.STARTUP[f"cog {name}"] = time.perf_counter()-started
     return bot
@@ -3,6 +3,10 @@ import discord
 from discord.ext import commands
 from discord import Embed, Status, Activity, ActivityType
 
+from utils import metrics
+from utils.downloader import engine
+from utils.watchdog import LoopWatchdog
+
 
 def format_duration(duration: int):
     duration, seconds = divmod(duration, 60)
@@ -14,11 +18,46 @@ def format_duration(duration: int):
     return f"{hours}h {minutes}m {seconds}s"
 
 
+def format_series(series):
+    if not series.count:
+        return "no samples"
+    ms = lambda seconds: f"{seconds*1000:.1f}ms"
+    return f"{series.count}x, avg {ms(series.sum/series.count)}, p50 {ms(series.quantile(0.5))}, p95 {ms(series.quantile(0.95))}, p99 {ms(series.quantile(0.99))}"
+
+
 class Core(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.start = round(time.time())
         self.set_presence = self.normal_presence
+        self.monitoring = False
+        self.metrics_server = None
+        self.watchdog = LoopWatchdog(bot.PRINTER, threshold=float(bot.CONFIG.get("LOOP_BLOCK_THRESHOLD_MS", 100))/1000)
+        bot.before_invoke(self.before_command)
+        bot.after_invoke(self.after_command)
+    
+    def cog_unload(self):
+        # The hooks are the bot's, a reloaded cog would otherwise leave them bound to this instance
+        if self.bot._before_invoke == self.before_command:
+            self.bot._before_invoke = None
+        if self.bot._after_invoke == self.after_command:
+            self.bot._after_invoke = None
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.watchdog.stop()
+    
+    async def before_command(self, ctx):
+        ctx.invoked_at = time.perf_counter()
+    
+    async def after_command(self, ctx):
+        # Also runs for failed commands, checks and cooldowns are not timed
+        invoked_at = getattr(ctx, 'invoked_at', None)
+        if invoked_at is None or ctx.command is None:
+            return
+        name = ctx.command.qualified_name
+        metrics.command_seconds.labels(name).observe(time.perf_counter()-invoked_at)
+        if getattr(ctx, 'command_failed', False):
+            metrics.command_errors.inc(name)
 
     async def normal_presence(self):
         await self.bot.change_presence(status=Status.online, activity=Activity(type=ActivityType.listening, name="Prefix[~]"))
@@ -31,13 +70,32 @@ class Core(commands.Cog):
         print("Connection Established.")
         print(f"{f'Connected As [{self.bot.user.name}]':^25}\n")
         await self.set_presence()
+        # on_ready fires again after reconnects, the watchdog only starts once
+        if not self.monitoring:
+            self.monitoring = True
+            self.watchdog.start()
+        if self.metrics_server is None and self.bot.CONFIG.get("METRICS_PORT"):
+            self.metrics_server = metrics.MetricsServer(metrics.registry, int(self.bot.CONFIG["METRICS_PORT"]))
+            await self.metrics_server.start()
 
     def get_info_embed(self, ctx):
         embed=Embed(title="Bot Information", color=discord.Colour.dark_blue())
         embed.add_field(name="Client Name", value=self.bot.user.name, inline=False)
-        embed.add_field(name=f'Servers', value=f'Serving {len(self.bot.guilds)} servers', inline=False)
+        totals = self.bot.CLUSTER.totals if self.bot.CLUSTER is not None else None
+        if totals is not None:
+            embed.add_field(name=f'Servers', value=f"Serving {totals['guilds']} servers over {totals['clusters']} clusters ({totals['shards']} shards)", inline=False)
+        else:
+            embed.add_field(name=f'Servers', value=f'Serving {len(self.bot.guilds)} servers', inline=False)
         embed.add_field(name="Uptime", value=format_duration(round(time.time()-self.start)), inline=False)
         embed.add_field(name="Latency", value=f"{round(self.bot.latency*1000)} ms")
+        if totals is not None:
+            embed.add_field(name="Cluster Latency", value=f"{round(totals['latency']*1000)} ms")
+        music_queue = self.bot.get_cog('MusicQueue')
+        if music_queue is not None:
+            counts = music_queue.get_session_counts()
+            embed.add_field(name="Sessions", value=f"{len(self.bot.voice_clients)} voice, {counts['queues']} queues ({counts['playing']} playing)", inline=False)
+            if totals is not None:
+                embed.add_field(name="Cluster Sessions", value=f"{totals['voice']} voice, {totals['queues']} queues", inline=False)
         embed.add_field(name="Prefix", value=f"Prefix [~]", inline=False)
         embed.add_field(name="Source Code", value="[Github Repo](https://github.com/Vin-Ren/lightbulb-2.0)", inline=False)
         embed.set_footer(icon_url=ctx.author.avatar.url, text=f"Requested by {ctx.author.name}")
@@ -65,6 +123,40 @@ class Core(commands.Cog):
         embed = self.get_info_embed(ctx)
         await ctx.respond(embeds=[embed])
 
+    def get_stats_embed(self, ctx):
+        embed=Embed(title="Performance Stats", color=discord.Colour.dark_blue())
+        embed.add_field(name="Event Loop Lag", value=format_series(metrics.loop_lag_seconds.labels()), inline=False)
+        embed.add_field(name="Extraction", value="\n".join(f"{kind}: {format_series(series)}" for (kind,), series in metrics.extraction_seconds.series()) or "no samples", inline=False)
+        lookups = {result: metrics.metadata_cache_lookups.value(result) for result in ('hit', 'stale', 'miss')}
+        embed.add_field(name="Metadata Cache", value=f"{lookups['hit']} hits, {lookups['stale']} stale, {lookups['miss']} misses, {engine.timeouts} extraction timeouts", inline=False)
+        embed.add_field(name="Source Creation", value="\n".join(f"{mode}: {format_series(series)}" for (mode,), series in metrics.source_create_seconds.series()) or "no samples", inline=False)
+        embed.add_field(name="FFmpeg Spawn", value=format_series(metrics.ffmpeg_spawn_seconds.labels()), inline=False)
+        embed.add_field(name="Queue Transitions", value=format_series(metrics.queue_transition_seconds.labels()), inline=False)
+        # Slowest commands first, an embed field holds at most 1024 characters
+        commands_ = sorted(metrics.command_seconds.series(), key=lambda item: item[1].quantile(0.95) or 0, reverse=True)
+        lines = [f"{name}: {format_series(series)}" + (f", {int(metrics.command_errors.value(name))} failed" if metrics.command_errors.value(name) else "") for (name,), series in commands_]
+        embed.add_field(name="Commands", value="\n".join(lines)[:1024] or "no samples", inline=False)
+        embed.set_footer(icon_url=ctx.author.avatar.url, text=f"Requested by {ctx.author.name}")
+        return embed
+
+    @commands.command(brief="Shows Performance Stats", hidden=True)
+    @commands.is_owner()
+    async def stats(self, ctx):
+        await ctx.send(embeds=[self.get_stats_embed(ctx)])
+
+    def get_blocks_embed(self, ctx):
+        embed=Embed(title="Event Loop Blocks", color=discord.Colour.dark_blue())
+        embed.description = f"{self.watchdog.blocks} blocks over {round(self.watchdog.threshold*1000)}ms, {format_series(metrics.loop_block_seconds.labels())}"
+        for site, seconds, blocks, longest in self.watchdog.worst(10):
+            embed.add_field(name=site[:256], value=f"{seconds*1000:.0f}ms blocked, {blocks} blocks, longest {longest*1000:.0f}ms", inline=False)
+        embed.set_footer(icon_url=ctx.author.avatar.url, text=f"Requested by {ctx.author.name}")
+        return embed
+
+    @commands.command(brief="Shows Where The Event Loop Blocked", hidden=True)
+    @commands.is_owner()
+    async def blocks(self, ctx):
+        await ctx.send(embeds=[self.get_blocks_embed(ctx)])
+
     @commands.command(brief=f"Clears an amount of messages from the channel")
     @commands.has_permissions(manage_messages=True)
     async def clear(self, ctx, amount=5):
@@ -1,32 +1,120 @@
 
 import asyncio
 import time
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
 
 import discord
 from discord.ext import commands, pages, bridge
-from utils.downloader import YTDLSource
+from utils.downloader import YTDLSource, OpusSource, WorkerSource, QueueEntry, FRAME_SIZE, iter_playlist, note_play, admission
+from utils import metrics
+from utils.track_queue import TrackQueue, QueueFull
+from utils.sessions import session_store
+from utils.search import search_completer
+from utils.admission import Overloaded
+from utils.printer import print_error
+
+
+class RestoredContext:
+    "Stands in for the command context of a restored session until someone uses a command"
+    def __init__(self, channel: discord.TextChannel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = channel.guild.me
+    
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+
+class QueuePages(Sequence):
+    "Pages of a queue for pages.Paginator, only the page being shown is rendered. Played entries are not listed"
+    def __init__(self, queue_manager: "QueueManager", per_page: int = 4):
+        self.queue_manager = queue_manager
+        self.per_page = per_page
+    
+    def __len__(self):
+        return max(1, -(-len(self.queue_manager.queue)//self.per_page))
+    
+    def __iter__(self):
+        for page in range(len(self)):
+            yield self[page]
+    
+    def __getitem__(self, page: int):
+        if page < 0:
+            page += len(self)
+        if page < 0:
+            raise IndexError("page index out of range")
+        # The paginator counts its pages once, the queue may have shrunk since
+        page = min(page, len(self)-1)
+        if not self.queue_manager.queue:
+            return discord.Embed(title="The queue is empty....")
+        start = page*self.per_page
+        return [self.queue_manager.get_entry_embed(index) for index in range(start, min(start+self.per_page, len(self.queue_manager.queue)))]
 
 
 class QueueManager:
-    def __init__(self, bot: commands.Bot, voice_channel: discord.VoiceClient, recent_ctx: commands.Context):
-        self.queue: list[YTDLSource] = []
+    def __init__(self, bot: commands.Bot, voice_channel: discord.VoiceClient, recent_ctx: commands.Context, prefetch_depth: int = 1, prefetch_buffer_bytes: int = 1024*1024, audio_mode: str = "pcm"):
+        self.queue = TrackQueue()
         self.bot = bot
-        self._index = 0
         self._current_vc = voice_channel
         self.recent_ctx = recent_ctx
         self._volume = 1.0
-        self.lock = asyncio.Lock()
+        self.audio_mode = audio_mode
+        self._player_task: asyncio.Task | None = None
+        self._advance = True
+        self._skip_pending = False
+        # Up to prefetch_depth upcoming entries get their decoder started ahead of time,
+        # sharing prefetch_buffer_bytes of buffered audio
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_buffer_bytes = prefetch_buffer_bytes
+        self._prefetching: dict[QueueEntry, asyncio.Task] = {}
+        self._prefetched: set[QueueEntry] = set()
+        # Rendered embeds of recently viewed entries, along with the url they were rendered for
+        self._embeds: OrderedDict[QueueEntry, tuple[str | None, discord.Embed]] = OrderedDict()
+        self.max_cached_embeds = 256
+        # Stream urls of the first lease_window entries are renewed in the background, lease_lead
+        # seconds before they expire and lease_batch at a time, so playing them never waits on extraction
+        self.lease_window = 25
+        self.lease_lead = 15*60
+        self.lease_batch = 4
+        self.lease_retry = 30
+        self._renewing = False
+        # Keyed by manager, the manager replacing this one in the guild schedules its own renewals
+        self._renewal_key = ("stream urls", id(self))
+        # Entries whose renewal failed are left to be resolved when they play
+        self._renewal_failed: set[QueueEntry] = set()
+    
+    @classmethod
+    def from_snapshot(cls, bot: commands.Bot, snapshot: dict, recent_ctx, **options):
+        "Rebuilds a queue from its metadata, stream urls are resolved again once their entries are about to play"
+        qm = cls(bot, None, recent_ctx, **options)
+        qm._volume = snapshot["volume"]
+        if snapshot["current"] is not None:
+            qm.queue.current = QueueEntry(snapshot["current"])
+        qm.queue.extend(QueueEntry(data) for data in snapshot["upcoming"][:qm.queue.max_upcoming])
+        return qm
+    
+    def snapshot_key(self):
+        "Changes whenever the snapshot would"
+        connected = self._current_vc is not None and self._current_vc.is_connected()
+        return (self.queue.version, self._volume, self._current_vc.channel.id if connected else None, self.is_active)
+    
+    def snapshot(self):
+        _, _, voice_channel, playing = self.snapshot_key()
+        return {"voice_channel": voice_channel,
+                "text_channel": self.recent_ctx.channel.id,
+                "volume": self._volume,
+                "playing": playing,
+                "current": self.queue.current.data if self.queue.current is not None else None,
+                "upcoming": [entry.data for entry in self.queue.upcoming]}
     
     @property
-    def index(self):
-        return self._index
+    def guild_id(self):
+        return self.recent_ctx.guild.id
     
-    @index.setter
-    def index(self, newidx:int):
-        self._index=newidx
-        if (self._current_vc is None): return
-        self._current_vc.stop()
-        self.bot.loop.run_in_executor(None, lambda :(self.play(self._current_vc)))
+    @property
+    def is_active(self):
+        return self._player_task is not None and not self._player_task.done()
     
     @property
     def volume(self):
@@ -35,27 +123,29 @@ class QueueManager:
     @volume.setter
     def volume(self, new_volume):
         self._volume=new_volume
-        if self._current_vc.source is not None:
+        if self._current_vc is not None and self._current_vc.source is not None:
             self._current_vc.source.volume=self._volume
     
+    def get_entry_embed(self, index: int):
+        "Embed of the entry at index, 0 being the current entry if there is one"
+        entry = self.queue[index]
+        cached = self._embeds.get(entry)
+        # Resolving an entry changes its url and may fill in its metadata
+        if cached is None or cached[0] != entry.url:
+            cached = (entry.url, entry.create_discord_embed())
+            self._embeds[entry] = cached
+            if len(self._embeds) > self.max_cached_embeds:
+                self._embeds.popitem(last=False)
+        self._embeds.move_to_end(entry)
+        # The cached embed may be shown at other positions, only copies get a title
+        embed = cached[1].copy()
+        if self.queue.current is None:
+            index += 1
+        embed.title="Now Playing" if index == 0 else f"Entry#{index}"
+        return embed
+    
     def get_pages(self, per_page: int = 4):
-        embeds = [src.create_discord_embed() for src in self.queue]
-        _pages=[]
-        for i, page in enumerate(embeds):
-            page.title=f"Entry#{i+1}"
-        i=0
-        cpage = []
-        while i<len(embeds):
-            cpage.append(embeds[i])
-            if (i+1)%per_page==0:
-                _pages.append(cpage.copy())
-                cpage.clear()
-            i+=1
-        if len(cpage):
-            _pages.append(cpage)
-        if len(_pages)<=0:
-            _pages.append(discord.Embed(title="The queue is empty...."))
-        return _pages
+        return QueuePages(self, per_page)
 
     def get_paginator(self):
         page_buttons = [
@@ -79,59 +169,396 @@ class QueueManager:
         )
         return paginator
     
-    def enqueue(self, src: YTDLSource):
-        self.queue.append(src)
-    
-    async def add_from_url(self, url):
-        while self.lock.locked():
-            await asyncio.sleep(1)
-        await self.lock.acquire()
-        entry = await YTDLSource.from_url(url, loop=self.bot.loop, stream=True)
+    def enqueue(self, entry: QueueEntry):
         self.queue.append(entry)
-        self.lock.release()
+    
+    async def add_from_url(self, url, position: int | None = None):
+        "Resolves url and appends it, or inserts it at position"
+        self.queue.ensure_room()
+        entry = await QueueEntry.from_url(url, loop=self.bot.loop, guild_id=self.guild_id)
+        if position is None:
+            self.queue.append(entry)
+        else:
+            self.insert(position, entry)
         return entry
     
+    async def add_playlist(self, url: str, max_entries: int = 200):
+        "Appends the entries of a playlist as its pages arrive, yielding each added entry"
+        self.queue.ensure_room()
+        async for entry in iter_playlist(url, max_entries=min(max_entries, self.queue.room), guild_id=self.guild_id):
+            self.queue.append(entry)
+            yield entry
+    
+    async def add_many(self, urls: list[str], concurrency: int = 4):
+        """Resolves urls concurrently, yielding (position, entry or exception) as each one finishes.
+        
+        Entries are appended to the queue in the order of `urls`, failed ones are skipped.
+        Entries which no longer fit once their turn to be appended comes, the queue
+        having filled up meanwhile, are yielded a second time along with the QueueFull error."""
+        self.queue.ensure_room(len(urls))
+        semaphore = asyncio.Semaphore(concurrency)
+        async def resolve(position: int, url: str):
+            async with semaphore:
+                try:
+                    return position, await QueueEntry.from_url(url, loop=self.bot.loop, guild_id=self.guild_id, kind="bulk")
+                except Exception as exc:
+                    return position, exc
+        
+        tasks = [asyncio.ensure_future(resolve(position, url)) for position, url in enumerate(urls)]
+        finished = {}
+        inserted = 0
+        try:
+            for next_finished in asyncio.as_completed(tasks):
+                position, result = await next_finished
+                finished[position] = result
+                dropped = []
+                while inserted in finished:
+                    entry = finished.pop(inserted)
+                    if isinstance(entry, QueueEntry):
+                        try:
+                            self.queue.append(entry)
+                        except QueueFull as exc:
+                            entry.release()
+                            dropped.append((inserted, exc))
+                    inserted += 1
+                yield position, result
+                for dropped_position, exc in dropped:
+                    yield dropped_position, exc
+        finally:
+            for task in tasks:
+                task.cancel()
+    
     def skip(self):
-        self.index=self.index
+        if not self._interrupt() and self.is_active:
+            # Nothing plays while the next entry loads, the player loop skips it before playing
+            self._skip_pending = True
+    
+    def previous(self):
+        "Makes the last played entry current again, returns False when there is none"
+        if self.queue.previous() is None:
+            return False
+        if self.is_active:
+            self._advance = False
+            self._interrupt()
+        return True
+    
+    def insert(self, position: int, entry: QueueEntry):
+        self.queue.insert(position, entry)
+        self._queue_changed()
+    
+    def remove(self, position: int):
+        entry = self.queue.remove(position)
+        entry.release()
+        self._prefetched.discard(entry)
+        self._renewal_failed.discard(entry)
+        self._embeds.pop(entry, None)
+        self._queue_changed()
+        return entry
+    
+    def move(self, position: int, new_position: int):
+        entry = self.queue.move(position, new_position)
+        self._queue_changed()
+        return entry
+    
+    def shuffle(self):
+        self.queue.shuffle()
+        self._queue_changed()
+    
+    def _queue_changed(self):
+        # Entries which are no longer up next stop holding a decoder
+        if self.is_active:
+            self._update_prefetch()
+            self._schedule_renewal()
     
     def reset(self):
-        if (self._current_vc is not None):
-            self._current_vc.stop()
+        self._stop_playback()
         self.queue.clear()
-        self.index=0
+        self._prefetched.clear()
+        self._renewal_failed.clear()
+        self._embeds.clear()
+        self.bot.SCHEDULER.cancel(self._renewal_key)
     
     async def stop(self):
-        self._current_vc.stop()
+        self._stop_playback()
+    
+    def _interrupt(self):
+        "Stops the current track, returns False when no track was playing"
+        # Stopping the voice client fires the after callback of the current track
+        if self._current_vc is not None and (self._current_vc.is_playing() or self._current_vc.is_paused()):
+            self._current_vc.stop()
+            return True
+        return False
+    
+    def _stop_playback(self):
+        self._skip_pending = False
+        if self._player_task is not None:
+            self._player_task.cancel()
+            self._player_task = None
+        if self._current_vc is not None:
+            self._current_vc.stop()
+    
+    def _wanted_entries(self):
+        return self.queue.window(0, 1+self.prefetch_depth)
+    
+    def _update_prefetch(self):
+        "Drops prepared entries which are no longer up next and prepares the ones that are"
+        wanted = self._wanted_entries()
+        for entry in list(self._prefetched):
+            if entry not in wanted:
+                entry.release()
+                self._prefetched.discard(entry)
+        upcoming = wanted[1:]
+        if not upcoming:
+            return
+        buffer_frames = self.prefetch_buffer_bytes//len(upcoming)//FRAME_SIZE
+        for entry in upcoming:
+            if entry.source is None and entry not in self._prefetched and entry not in self._prefetching:
+                self._prefetching[entry] = self.bot.loop.create_task(self._prefetch(entry, buffer_frames))
+    
+    async def _prefetch(self, entry: QueueEntry, buffer_frames: int):
+        try:
+            if not entry.url_is_fresh():
+                await entry.refresh(loop=self.bot.loop, guild_id=self.guild_id, kind="bulk")
+            await self.bot.loop.run_in_executor(None, lambda: entry.prepare(buffer_frames, volume=self.volume, mode=self.audio_mode))
+        except Exception as exc:
+            # The entry is simply prepared when it starts playing
+            print_error("Prefetch Error", exc, title=entry.title)
+        finally:
+            self._prefetching.pop(entry, None)
+        # The queue may have changed while the decoder was starting
+        if entry in self._wanted_entries():
+            self._prefetched.add(entry)
+        else:
+            entry.release()
+    
+    def _renewable_entries(self):
+        "Resolved entries of the lease window which still have to be started from their stream url, in queue order"
+        window = self.queue.window(0, 1+self.lease_window)
+        # Failed entries which left the window are not tracked any longer
+        self._renewal_failed.intersection_update(window)
+        return [entry for entry in window
+                if entry.expires_at is not None and entry.source is None and entry.prepared is None and entry.local_path is None
+                and entry not in self._renewal_failed]
+    
+    def _schedule_renewal(self):
+        "Schedules renewing the stream urls of the window for when the first of them gets within lease_lead of expiring"
+        if self._renewing:
+            # Reschedules itself once the batch is done
+            return
+        entries = self._renewable_entries() if self.is_active else []
+        if not entries:
+            self.bot.SCHEDULER.cancel(self._renewal_key)
+            return
+        # Unresolved playlist entries are left to prefetching, which resolves them as they come up
+        expires_at = min(entry.expires_at for entry in entries)
+        self.bot.SCHEDULER.schedule(self._renewal_key, max(expires_at-self.lease_lead-time.time(), 0), self._renew_stream_urls)
+    
+    async def _renew_stream_urls(self):
+        if not self.is_active:
+            return
+        if admission.waiting:
+            # Extractions are queueing up, renewals wait for an idle moment
+            self.bot.SCHEDULER.schedule(self._renewal_key, self.lease_retry, self._renew_stream_urls)
+            return
+        batch = [entry for entry in self._renewable_entries() if not entry.url_is_fresh(self.lease_lead)][:self.lease_batch]
+        self._renewing = True
+        try:
+            results = await asyncio.gather(*(entry.refresh(loop=self.bot.loop, guild_id=self.guild_id, kind="bulk", fresh_for=self.lease_lead) for entry in batch),
+                                           return_exceptions=True)
+        finally:
+            self._renewing = False
+        for entry, result in zip(batch, results):
+            if isinstance(result, Overloaded):
+                continue
+            if isinstance(result, Exception):
+                print_error("Stream Url Renewal Error", result, title=entry.title)
+                self._renewal_failed.add(entry)
+            elif not entry.url_is_fresh(self.lease_lead):
+                # Urls living shorter than lease_lead would be renewed over and over
+                self._renewal_failed.add(entry)
+        if any(isinstance(result, Overloaded) for result in results):
+            self.bot.SCHEDULER.schedule(self._renewal_key, self.lease_retry, self._renew_stream_urls)
+            return
+        self._schedule_renewal()
     
     async def play(self, voice_client: discord.VoiceClient):
         self._current_vc=voice_client
-        while self.lock.locked():
-            await asyncio.sleep(1)
-        while voice_client.is_connected() and self.index<len(self.queue):
-            player = self.queue[self.index]
-            player.volume=self.volume
-            embed = player.create_discord_embed(color=self.recent_ctx.author.color)
-            embed.title=embed.title+f" ({self.index+1} of {len(self.queue)})"
-            await self.recent_ctx.send(embed=embed)
-            voice_client.play(player, after=lambda e: print(f"Player error: {e}") if e else None)
-            while voice_client.is_playing():
-                await asyncio.sleep(1)
-            self._index+=1
+        if not self.is_active:
+            self._player_task = self.bot.loop.create_task(self._playback())
+    
+    async def _playback(self):
+        try:
+            await self._play_entries(self._current_vc)
+        except Exception as exc:
+            print_error("Queue Playback Error", exc, guild=self.guild_id)
+    
+    async def _play_entries(self, voice_client: discord.VoiceClient):
+        loop = asyncio.get_running_loop()
+        # When the previous track ended, the gap to the next one is the transition time
+        ended_at = None
+        while voice_client.is_connected():
+            # Resuming a stopped queue plays its current entry again
+            entry = self.queue.current if self.queue.current is not None else self.queue.advance()
+            if entry is None:
+                break
+            # A future per track, so a late callback of a stopped track can not end the next one
+            finished = loop.create_future()
+            def after(error, finished=finished):
+                if error:
+                    print_error("Player Error", error)
+                loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+            self._advance = True
+            try:
+                pending = self._prefetching.get(entry)
+                if pending is not None:
+                    await asyncio.shield(pending)
+                self._prefetched.discard(entry)
+                if entry.prepared is None and not entry.url_is_fresh():
+                    try:
+                        await entry.refresh(loop=loop, guild_id=self.guild_id)
+                    except Exception as exc:
+                        self.bot.MESSAGES.send(self.recent_ctx, content=f"Skipping {entry.title or 'an entry'}, it could not be loaded.")
+                        print_error("Queue Entry Error", exc, title=entry.title)
+                        self._renewal_failed.discard(entry)
+                        # The failed entry used up a skip sent while it loaded
+                        self._skip_pending = False
+                        if entry is self.queue.current:
+                            self.queue.advance()
+                        continue
+                # Skips and previous may have come in while the entry loaded
+                if self._skip_pending:
+                    self._skip_pending = False
+                    self.queue.advance()
+                    continue
+                if entry is not self.queue.current:
+                    continue
+                voice_client.play(entry.create_source(volume=self.volume, mode=self.audio_mode), after=after)
+                if ended_at is not None:
+                    metrics.queue_transition_seconds.observe(loop.time()-ended_at)
+                self._update_prefetch()
+                self._renewal_failed.discard(entry)
+                self._schedule_renewal()
+                note_play(entry.data, loop=loop)
+                embed = entry.create_discord_embed(color=self.recent_ctx.author.color)
+                embed.title=embed.title+f" ({len(self.queue.upcoming)} up next)"
+                # Tracks skipped in a burst only announce the last one
+                self.bot.MESSAGES.send(self.recent_ctx, key=("now playing", self.guild_id), embed=embed)
+                await finished
+                ended_at = loop.time()
+            finally:
+                entry.release()
+            if self._advance:
+                self.queue.advance()
 
 
 class MusicQueue(commands.Cog):
     def __init__(self, bot_: commands.Bot):
         self.bot = bot_
         self.queue_managers: dict[int, QueueManager] = {}
+        self.playlist_max_entries = int(bot_.CONFIG.get("PLAYLIST_MAX_ENTRIES", 200))
+        self.audio_mode = bot_.CONFIG.get("AUDIO_MODE", "pcm")
+        # Queue managers are dropped along with their queue after being idle this long
+        self.idle_timeout = 30*60
+        self.snapshot_interval = float(bot_.CONFIG.get("SESSION_SNAPSHOT_INTERVAL", 30))
+        # Restored sessions resume playing one after another, this many seconds apart
+        self.resume_spacing = 2
+        self._snapshot_keys: dict[int, tuple] = {}
+        self._restored = False
+    
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready fires again after reconnects, sessions are only restored once
+        if self._restored or not session_store.enabled:
+            return
+        self._restored = True
+        snapshots = await self.bot.loop.run_in_executor(None, session_store.load_all)
+        resumes = 0
+        for guild_id, snapshot in snapshots.items():
+            if guild_id in self.queue_managers or not self.restore_session(guild_id, snapshot):
+                continue
+            if snapshot["playing"] and snapshot["voice_channel"] is not None:
+                resume = lambda guild_id=guild_id, channel_id=snapshot["voice_channel"]: self.resume_session(guild_id, channel_id)
+                self.bot.SCHEDULER.schedule(("resume", guild_id), resumes*self.resume_spacing, resume)
+                resumes += 1
+        self.schedule_snapshots()
+    
+    def restore_session(self, guild_id: int, snapshot: dict):
+        guild = self.bot.get_guild(guild_id)
+        # Guilds of other clusters are left to them
+        channel = guild.get_channel(snapshot["text_channel"]) if guild is not None else None
+        if channel is None or (snapshot["current"] is None and not snapshot["upcoming"]):
+            return False
+        qm = QueueManager.from_snapshot(self.bot, snapshot, RestoredContext(channel), audio_mode=self.audio_mode)
+        self.queue_managers[guild_id] = qm
+        self._snapshot_keys[guild_id] = qm.snapshot_key()
+        self.schedule_eviction(guild_id)
+        return True
+    
+    async def resume_session(self, guild_id: int, channel_id: int):
+        qm = self.queue_managers.get(guild_id)
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(channel_id) if guild is not None else None
+        if qm is None or qm.is_active or channel is None or guild.voice_client is not None:
+            return
+        voice_client = await channel.connect()
+        # Same voice state as joining for the play command
+        await guild.change_voice_state(channel=channel, self_mute=False, self_deaf=True)
+        await qm.play(voice_client)
+    
+    def schedule_snapshots(self):
+        self.bot.SCHEDULER.schedule("session snapshots", self.snapshot_interval, self.save_snapshots)
+    
+    def collect_snapshots(self):
+        "Returns the snapshots of sessions which changed since the last call, and the guilds whose session ended"
+        changed = {}
+        for guild_id, qm in self.queue_managers.items():
+            key = qm.snapshot_key()
+            if self._snapshot_keys.get(guild_id) != key:
+                changed[guild_id] = qm.snapshot()
+                self._snapshot_keys[guild_id] = key
+        ended = [guild_id for guild_id in self._snapshot_keys if guild_id not in self.queue_managers]
+        for guild_id in ended:
+            del self._snapshot_keys[guild_id]
+        return changed, ended
+    
+    async def save_snapshots(self):
+        try:
+            changed, ended = self.collect_snapshots()
+            if changed or ended:
+                await self.bot.loop.run_in_executor(None, session_store.write, changed, ended)
+        finally:
+            self.schedule_snapshots()
     
     async def get_guild_queue_manager(self, ctx: commands.Context):
         if (self.queue_managers.get(ctx.guild.id) is None):
             if (ctx.author.voice is None):
                 await ctx.send("You are not connected to a voice channel.")
                 raise commands.CommandError("Author not connected to a voice channel.")
-            self.queue_managers[ctx.guild.id] = QueueManager(self.bot, ctx.author.voice.channel, ctx.message)
+            self.queue_managers[ctx.guild.id] = QueueManager(self.bot, ctx.voice_client, ctx.message, audio_mode=self.audio_mode)
         self.queue_managers[ctx.guild.id].recent_ctx=ctx
+        self.schedule_eviction(ctx.guild.id)
         return self.queue_managers[ctx.guild.id]
+    
+    def schedule_eviction(self, guild_id: int):
+        self.bot.SCHEDULER.schedule(("queue", guild_id), self.idle_timeout, lambda: self.evict_idle(guild_id))
+    
+    async def evict_idle(self, guild_id: int):
+        qm = self.queue_managers.get(guild_id)
+        if qm is None:
+            return
+        if qm.is_active:
+            self.schedule_eviction(guild_id)
+            return
+        qm.reset()
+        del self.queue_managers[guild_id]
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None and guild.voice_client is not None and not guild.voice_client.is_playing():
+            await guild.voice_client.disconnect(force=True)
+    
+    def get_session_counts(self):
+        return {'queues': len(self.queue_managers),
+                'playing': sum(qm.is_active for qm in self.queue_managers.values()),
+                'entries': sum(len(qm.queue) for qm in self.queue_managers.values())}
 
     @commands.command(aliases=['showq'])
     async def show_queue(self, ctx: commands.Context):
@@ -151,35 +578,90 @@ class MusicQueue(commands.Cog):
     async def multi_queue(self, ctx: commands.Context, *, url:str):
         "Adds multiple item to the queue, seperated by commas [,]"
         qm = await self.get_guild_queue_manager(ctx)
+        names = [name.strip() for name in url.split(',') if name.strip()]
+        if len(names) > qm.queue.room:
+            await ctx.send(f"Only {qm.queue.room} more entries fit into the queue.")
+            return
         with ctx.typing():
-            for name in url.split(','):
-                entry = await qm.add_from_url(name)
-                embed = entry.create_discord_embed()
-                embed.title="Added entry"
-                await ctx.send(embed=embed)
+            async for position, result in qm.add_many(names):
+                if isinstance(result, QueueFull):
+                    line = f"Dropped entry #{position+1} ({names[position]}). {result}"
+                elif isinstance(result, Overloaded):
+                    line = f"Failed to add entry #{position+1} ({names[position]}). {result}"
+                elif isinstance(result, Exception):
+                    line = f"Failed to add entry #{position+1} ({names[position]})."
+                else:
+                    line = f"Added entry #{position+1} [{result.title}]({result.webpage_url})"
+                # Confirmations arriving close together share a message
+                self.bot.MESSAGES.send_batched(ctx, ("multi queue", ctx.message.id), line, self.render_queue_updates)
+    
+    @staticmethod
+    def render_queue_updates(lines: list[str]):
+        embed = discord.Embed(title=f"Queue updates ({len(lines)})", description="\n".join(lines)[:4096])
+        return {"embed": embed}
 
     @commands.command(aliases=['eq', 'enq'])
     async def enqueue(self, ctx: commands.Context, *, url: str):
         "Adds the entry to the queue"
         qm = await self.get_guild_queue_manager(ctx)
-        with ctx.typing():
-            entry = await qm.add_from_url(url)
+        try:
+            with ctx.typing():
+                entry = await qm.add_from_url(url)
+        except (QueueFull, Overloaded) as exc:
+            await ctx.send(str(exc))
+            return
         embed = entry.create_discord_embed()
         embed.title="Added entry"
         await ctx.send(embed=embed)
     
     @commands.slash_command(name='enqueue')
-    @discord.option("url", description="Url or query of the source")
+    @discord.option("url", description="Url or query of the source", autocomplete=search_completer.complete)
     async def slash_enqueue(self, ctx: discord.ApplicationContext, url: str):
         "Adds the entry to the queue"
         qm = await self.get_guild_queue_manager(ctx)
         response = await ctx.respond(content="Processing request...")
         with ctx.typing():
-            entry = await qm.add_from_url(url)
+            try:
+                entry = await qm.add_from_url(url)
+            except (QueueFull, Overloaded) as exc:
+                await response.edit_original_response(content=str(exc))
+                return
             embed = entry.create_discord_embed()
             embed.title="Added entry"
             await response.edit_original_response(content="", embeds=[embed])
     
+    async def load_playlist(self, ctx, qm: QueueManager, url: str):
+        "Enqueues a playlist, starting playback as soon as its first entries are in"
+        added = 0
+        if not qm.queue.room:
+            return added
+        try:
+            async for entry in qm.add_playlist(url, max_entries=self.playlist_max_entries):
+                added += 1
+                if added == 1 and not qm.is_active and ctx.author.voice is not None:
+                    await self.ensure_clean_voice(ctx)
+                    await qm.play(ctx.voice_client)
+        except Overloaded as exc:
+            await ctx.send(f"Stopped loading the playlist after {added} entries. {exc}")
+        return added
+    
+    @commands.command(aliases=['pl'])
+    async def playlist(self, ctx: commands.Context, *, url: str):
+        "Adds the entries of a playlist to the queue and starts playing it"
+        qm = await self.get_guild_queue_manager(ctx)
+        msg = await ctx.send("Loading playlist...")
+        added = await self.load_playlist(ctx, qm, url)
+        await msg.edit(content=f"Added {added} entries from the playlist.")
+    
+    @commands.slash_command(name='playlist')
+    @discord.option("url", description="Url of the playlist")
+    async def slash_playlist(self, ctx: discord.ApplicationContext, url: str):
+        "Adds the entries of a playlist to the queue and starts playing it"
+        qm = await self.get_guild_queue_manager(ctx)
+        response = await ctx.respond(content="Loading playlist...")
+        added = await self.load_playlist(ctx, qm, url)
+        await response.edit_original_response(content=f"Added {added} entries from the playlist.")
+    
     @commands.command(aliases=['pq', 'playq'])
     async def play_queue(self, ctx: commands.Context):
         "Starts queue playback"
@@ -247,6 +729,106 @@ class MusicQueue(commands.Cog):
         qm.reset()
         await ctx.respond(content="Cleared queue")
     
+    @commands.command(aliases=['ins'])
+    async def insert(self, ctx: commands.Context, position: int, *, url: str):
+        "Adds the entry to the queue at position"
+        qm = await self.get_guild_queue_manager(ctx)
+        try:
+            with ctx.typing():
+                entry = await qm.add_from_url(url, position=position)
+        except (QueueFull, Overloaded) as exc:
+            await ctx.send(str(exc))
+            return
+        embed = entry.create_discord_embed()
+        embed.title="Inserted entry"
+        await ctx.send(embed=embed)
+    
+    @commands.slash_command(name='insert')
+    @discord.option("position", description="Position in the queue, 1 is up next")
+    @discord.option("url", description="Url or query of the source")
+    async def slash_insert(self, ctx: discord.ApplicationContext, position: int, url: str):
+        "Adds the entry to the queue at position"
+        qm = await self.get_guild_queue_manager(ctx)
+        response = await ctx.respond(content="Processing request...")
+        try:
+            entry = await qm.add_from_url(url, position=position)
+        except (QueueFull, Overloaded) as exc:
+            await response.edit_original_response(content=str(exc))
+            return
+        embed = entry.create_discord_embed()
+        embed.title="Inserted entry"
+        await response.edit_original_response(content="", embeds=[embed])
+    
+    @commands.command(aliases=['rm'])
+    async def remove(self, ctx: commands.Context, position: int):
+        "Removes the entry at position from the queue"
+        qm = await self.get_guild_queue_manager(ctx)
+        try:
+            entry = qm.remove(position)
+        except IndexError as exc:
+            await ctx.send(str(exc))
+            return
+        await ctx.send(f"Removed {entry.title}")
+    
+    @commands.slash_command(name='remove')
+    @discord.option("position", description="Position in the queue, 1 is up next")
+    async def slash_remove(self, ctx: discord.ApplicationContext, position: int):
+        "Removes the entry at position from the queue"
+        qm = await self.get_guild_queue_manager(ctx)
+        try:
+            entry = qm.remove(position)
+        except IndexError as exc:
+            await ctx.respond(content=str(exc))
+            return
+        await ctx.respond(content=f"Removed {entry.title}")
+    
+    @commands.command(aliases=['mv'])
+    async def move(self, ctx: commands.Context, position: int, new_position: int):
+        "Moves the entry at position to new_position"
+        qm = await self.get_guild_queue_manager(ctx)
+        try:
+            entry = qm.move(position, new_position)
+        except IndexError as exc:
+            await ctx.send(str(exc))
+            return
+        await ctx.send(f"Moved {entry.title} to #{min(max(new_position, 1), len(qm.queue.upcoming))}")
+    
+    @commands.slash_command(name='move')
+    @discord.option("position", description="Position of the entry to move")
+    @discord.option("new_position", description="Position to move the entry to")
+    async def slash_move(self, ctx: discord.ApplicationContext, position: int, new_position: int):
+        "Moves the entry at position to new_position"
+        qm = await self.get_guild_queue_manager(ctx)
+        try:
+            entry = qm.move(position, new_position)
+        except IndexError as exc:
+            await ctx.respond(content=str(exc))
+            return
+        await ctx.respond(content=f"Moved {entry.title} to #{min(max(new_position, 1), len(qm.queue.upcoming))}")
+    
+    @commands.command(aliases=['shuf'])
+    async def shuffle(self, ctx: commands.Context):
+        "Shuffles the upcoming entries"
+        qm = await self.get_guild_queue_manager(ctx)
+        qm.shuffle()
+        await ctx.send("Shuffled queue")
+    
+    @commands.slash_command(name='shuffle')
+    async def slash_shuffle(self, ctx: discord.ApplicationContext):
+        "Shuffles the upcoming entries"
+        qm = await self.get_guild_queue_manager(ctx)
+        qm.shuffle()
+        await ctx.respond(content="Shuffled queue")
+    
+    @commands.command(aliases=['prev', 'back'])
+    async def previous(self, ctx: commands.Context):
+        "Plays the previous entry again"
+        qm = await self.get_guild_queue_manager(ctx)
+        if not qm.previous():
+            await ctx.send("Nothing was played before.")
+            return
+        await ctx.send("Going back to the previous entry...")
+    
     @commands.command(aliases=['sq', 'stopq'])
     async def stop_queue(self, ctx: commands.Context):
         "Stops queue playing session"
@@ -289,30 +871,32 @@ class Music(commands.Cog):
     def __init__(self, bot_: commands.Bot):
         self.bot = bot_
         self.auto_disconnect_timeout = 15*60
-        self.task_interval = 60
-        self.last_timeout = {}
-        self.bg_tasks = [self.bot.loop.create_task(self.auto_disconnect_task())]
+        self.audio_mode = bot_.CONFIG.get("AUDIO_MODE", "pcm")
 
-    async def disconnect_vcs(self):
-        await self.bot.wait_until_ready()
-        curr_time = time.time()
-        timed_out_ctxs = []
-        for gid, (ctx, timeout_at) in self.last_timeout.items():
-            if timeout_at<curr_time:
-                timed_out_ctxs.append((gid, ctx))
-        
-        for gid, ctx in timed_out_ctxs:
-            self.last_timeout.pop(gid)
-            if ctx.voice_client is None or ctx.voice_client.is_playing(): 
-                continue
-            await ctx.send("Automatically disconnected from voice.")
-            await ctx.voice_client.disconnect(force=True)
-    
-    async def auto_disconnect_task(self):
-        await self.bot.wait_until_ready()
-        while not self.bot.is_closed():
-            await self.disconnect_vcs()
-            await asyncio.sleep(self.task_interval)
+    @property
+    def source_type(self):
+        return {"opus": OpusSource, "worker": WorkerSource}.get(self.audio_mode, YTDLSource)
+    
+    def after_stream(self, finished: Callable):
+        "After callback for voice_client.play, calls finished on the loop once the track ended or was stopped"
+        def after(error):
+            if error:
+                print_error("Player Error", error)
+            self.bot.loop.call_soon_threadsafe(finished)
+        return after
+    
+    def schedule_disconnect(self, ctx: commands.Context):
+        _id = ctx.guild.id if ctx.guild else 0
+        self.bot.SCHEDULER.schedule(("disconnect", _id), self.auto_disconnect_timeout, lambda: self.disconnect_idle(ctx))
+    
+    async def disconnect_idle(self, ctx: commands.Context):
+        if ctx.voice_client is None:
+            return
+        if ctx.voice_client.is_playing():
+            self.schedule_disconnect(ctx)
+            return
+        await ctx.send("Automatically disconnected from voice.")
+        await ctx.voice_client.disconnect(force=True)
 
     @commands.command()
     async def join(self, ctx: commands.Context, *, channel: discord.VoiceChannel):
@@ -330,31 +914,28 @@ class Music(commands.Cog):
         msg = await ctx.send(f"Processing request...")
         
         async with ctx.typing():
-            player = await YTDLSource.from_url(url, loop=self.bot.loop, stream=True)
-            ctx.voice_client.play(player, after=lambda e: print(f"Player error: {e}") if e else None)
+            player = await self.source_type.from_url(url, loop=self.bot.loop, stream=True, guild_id=ctx.guild.id)
+            embed = player.create_discord_embed(color=ctx.author.color)
+            ctx.voice_client.play(player, after=self.after_stream(lambda: self.bot.MESSAGES.edit(msg, content="Finished playing.", embeds=[embed])))
+            note_play(player.data, loop=self.bot.loop)
         
-        embed = player.create_discord_embed(color=ctx.author.color)
-        
-        await msg.edit(content="", embeds=[embed])
-        await asyncio.sleep(player.data["duration"])
-        await msg.edit(content="Finished playing.", embeds=[embed])
+        self.bot.MESSAGES.edit(msg, content="", embeds=[embed])
     
     @commands.slash_command(name='play')
-    @discord.option("url", description="Url or query of the source")
+    @discord.option("url", description="Url or query of the source", autocomplete=search_completer.complete)
     @discord.option("ephemeral", choices=["Normal", "Ephemeral"], default="Normal", description="Message visible only for you", required=False)
     async def slash_stream(self, ctx: discord.ApplicationContext, url: str, ephemeral: str):
         """Streams audio from a url or query"""
         ephemeral_ = (ephemeral == 'Ephemeral')
         response = await ctx.respond(content="Processing request...", ephemeral=ephemeral_)
         
-        player = await YTDLSource.from_url(url, loop=self.bot.loop, stream=True)
-        ctx.voice_client.play(player, after=lambda e: print(f"Player error: {e}") if e else None)
-        
+        player = await self.source_type.from_url(url, loop=self.bot.loop, stream=True, guild_id=ctx.guild.id)
         embed = player.create_discord_embed(color=ctx.author.color)
+        edit = lambda **kwargs: self.bot.MESSAGES.update(ctx.channel.id, response.edit_original_response, key=("edit", response.id), **kwargs)
+        ctx.voice_client.play(player, after=self.after_stream(lambda: edit(content="Finished playing.", embeds=[embed])))
+        note_play(player.data, loop=self.bot.loop)
         
-        await response.edit_original_response(content="", embeds=[embed])
-        await asyncio.sleep(player.data["duration"])
-        await response.edit_original_response(content="Finished playing.", embeds=[embed])
+        edit(content="", embeds=[embed])
 
     @commands.command(aliases=['vol', 'v'])
     async def volume(self, ctx: commands.Context, volume: int):
@@ -388,16 +969,17 @@ class Music(commands.Cog):
     @slash_stream.after_invoke
     @stream.after_invoke
     async def update_disconnect_timeout(self, ctx: commands.Context):
-        _id = ctx.guild.id if ctx.guild else 0
-        self.last_timeout[_id] = (ctx, time.time()+self.auto_disconnect_timeout)
+        self.schedule_disconnect(ctx)
     
     @slash_stream.error
-    async def handle_slash_stream_error(self, ctx, *_):
-        await ctx.respond("Something went wrong.")
+    async def handle_slash_stream_error(self, ctx, error):
+        error = getattr(error, 'original', error)
+        await ctx.respond(str(error) if isinstance(error, Overloaded) else "Something went wrong.")
     
     @stream.error
-    async def handle_stream_error(self, ctx, *_):
-        await ctx.send("Something went wrong.")
+    async def handle_stream_error(self, ctx, error):
+        error = getattr(error, 'original', error)
+        await ctx.send(str(error) if isinstance(error, Overloaded) else "Something went wrong.")
 
 
 def setup(bot):
@@ -2,21 +2,40 @@ import dotenv
 import os
 from argparse import ArgumentParser
 from bot import setup
+from utils.cluster import ClusterSupervisor, fetch_shard_count
 
 
-def main(development):
-    bot = setup(os.environ) #type:ignore
+def create_bot(development, **options):
+    bot = setup(os.environ, **options) #type:ignore
     token = os.getenv("TOKEN")
     if development:
         bot.cogs['Core'].set_presence = bot.cogs['Core'].maintenance_presence
         token = os.getenv("DEV_TOKEN")
+    return bot, token
+
+
+def main(development):
+    bot, token = create_bot(development)
     bot.run(token)
 
 
+def run_cluster(development, clusters, shard_count=None):
+    if shard_count is None:
+        shard_count = fetch_shard_count(os.getenv("DEV_TOKEN" if development else "TOKEN"))
+    # Every cluster needs at least one shard
+    shard_count = max(shard_count, clusters)
+    ClusterSupervisor(create_bot, development, clusters, shard_count).run()
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', dest="config_name", default='.env', help="Sets config file")
     parser.add_argument('-d', '--dev', action="store_true", dest="is_development", help="Sets development to true")
+    parser.add_argument('--clusters', dest="clusters", type=int, default=0, help="Runs the bot as this many processes, each with a slice of the shards")
+    parser.add_argument('--shards', dest="shard_count", type=int, default=None, help="Total shard count in cluster mode, asks discord when omitted")
     args = parser.parse_args()
     dotenv.load_dotenv(args.config_name)
-    main(args.is_development)
+    if args.clusters:
+        run_cluster(args.is_development, args.clusters, args.shard_count)
+    else:
+        main(args.is_development)
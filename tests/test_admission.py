@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from utils.admission import AdmissionController, Overloaded
+
+
+async def request(controller: AdmissionController, order: list, name: str, guild_id, kind: str = "interactive", hold: float = 0.01):
+    async with controller.admit(guild_id, kind):
+        order.append(name)
+        await asyncio.sleep(hold)
+
+
+def admitted(controller: AdmissionController, requests: list, promote: tuple = ()):
+    "Starts requests, a (name, guild, kind) each, with a slot taken, returns the order they are admitted in"
+    async def main():
+        order = []
+        busy = asyncio.create_task(request(controller, order, "busy", "busy"))
+        await asyncio.sleep(0)
+        tasks = {}
+        for name, guild_id, kind in requests:
+            tasks[name] = asyncio.create_task(request(controller, order, name, guild_id, kind))
+            await asyncio.sleep(0)
+        for name in promote:
+            controller.promote(tasks[name], "interactive")
+        await asyncio.gather(busy, *tasks.values())
+        return order[1:]
+    return asyncio.run(main())
+
+
+def test_guilds_share_the_slots_fairly():
+    controller = AdmissionController(slots=1, per_guild=1)
+    requests = [(f"a{index}", "a", "bulk") for index in range(3)] + [(f"b{index}", "b", "bulk") for index in range(2)]
+    assert admitted(controller, requests) == ["a0", "b0", "a1", "b1", "a2"]
+
+
+def test_interactive_requests_overtake_bulk_work():
+    controller = AdmissionController(slots=1, per_guild=1)
+    requests = [(f"bulk{index}", "a", "bulk") for index in range(3)] + [("interactive", "b", "interactive")]
+    assert admitted(controller, requests) == ["interactive", "bulk0", "bulk1", "bulk2"]
+
+
+def test_bulk_work_is_not_starved():
+    controller = AdmissionController(slots=1, per_guild=1)
+    requests = [("bulk", "a", "bulk")] + [(f"interactive{index}", "b", "interactive") for index in range(12)]
+    assert admitted(controller, requests).index("bulk") < 12
+
+
+def test_promoted_requests_queue_like_new_interactive_ones():
+    controller = AdmissionController(slots=1, per_guild=1)
+    requests = [(f"bulk{index}", "a", "bulk") for index in range(4)]
+    assert admitted(controller, requests, promote=("bulk3",)) == ["bulk3", "bulk0", "bulk1", "bulk2"]
+
+
+def test_guilds_at_their_limit_leave_slots_to_others():
+    controller = AdmissionController(slots=3, per_guild=1)
+    requests = [("a0", "a", "interactive"), ("a1", "a", "interactive"), ("b0", "b", "bulk")]
+    assert admitted(controller, requests) == ["a0", "b0", "a1"]
+
+
+def test_full_queues_are_turned_away():
+    async def main():
+        controller = AdmissionController(slots=1, per_guild=1, max_guild_queue=1, max_queue=2)
+        order = []
+        busy = asyncio.create_task(request(controller, order, "busy", "busy"))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(request(controller, order, "a", "a")), asyncio.create_task(request(controller, order, "b", "b"))]
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded, match="This server"):
+            await request(controller, order, "a again", "a")
+        with pytest.raises(Overloaded, match="too busy"):
+            await request(controller, order, "c", "c")
+        await asyncio.gather(busy, *waiting)
+        return controller.waiting, controller._in_use
+    assert asyncio.run(main()) == (0, 0)
+
+
+def test_cancelled_waiters_give_up_their_place():
+    async def main():
+        controller = AdmissionController(slots=1, per_guild=1)
+        order = []
+        busy = asyncio.create_task(request(controller, order, "busy", "busy"))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(request(controller, order, "cancelled", "a"))
+        later = asyncio.create_task(request(controller, order, "later", "a"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(busy, later)
+        return order, controller.waiting, controller._in_use
+    assert asyncio.run(main()) == (["busy", "later"], 0, 0)
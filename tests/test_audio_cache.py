@@ -0,0 +1,70 @@
+from utils.cache import AudioCache
+
+
+def write(directory, name: str, size: int):
+    path = directory / name
+    path.write_bytes(b"\0"*size)
+    return str(path)
+
+
+def played(cache: AudioCache, key: str, times: int):
+    "Records plays, returns whether any of them asked for a download"
+    return any([cache.record_play(key) for _ in range(times)])
+
+
+def test_tracks_are_downloaded_once_played_often_enough(tmp_path):
+    cache = AudioCache(min_plays=2)
+    cache.open(str(tmp_path))
+    assert not cache.record_play("a")
+    assert cache.record_play("a")
+    # Already downloading
+    assert not cache.record_play("a")
+    path = write(tmp_path, "a.webm", 10)
+    cache.store("a", path)
+    assert cache.lookup("a") == path
+    assert not cache.record_play("a")
+
+
+def test_least_played_files_are_evicted_first(tmp_path):
+    cache = AudioCache(max_bytes=25, min_plays=1)
+    cache.open(str(tmp_path))
+    for key, plays in (("rare", 1), ("often", 3), ("new", 2)):
+        assert played(cache, key, plays)
+        cache.store(key, write(tmp_path, f"{key}.webm", 10))
+    assert cache.lookup("rare") is None
+    assert not (tmp_path / "rare.webm").exists()
+    assert cache.lookup("often") is not None and cache.lookup("new") is not None
+
+
+def test_failed_downloads_back_off(tmp_path):
+    cache = AudioCache(min_plays=1, retry_after=60)
+    cache.open(str(tmp_path))
+    assert cache.record_play("a")
+    cache.store("a", None)
+    assert not cache.record_play("a")
+    cache.retry_after = 0
+    assert cache.record_play("a")
+
+
+def test_files_larger_than_the_cache_are_rejected(tmp_path):
+    cache = AudioCache(max_bytes=25, min_plays=1, retry_after=60)
+    cache.open(str(tmp_path))
+    assert cache.record_play("small")
+    cache.store("small", write(tmp_path, "small.webm", 10))
+    assert cache.record_play("huge")
+    cache.store("huge", write(tmp_path, "huge.webm", 30))
+    assert cache.lookup("huge") is None
+    assert not (tmp_path / "huge.webm").exists()
+    assert cache.lookup("small") is not None
+    assert not cache.record_play("huge")
+
+
+def test_index_survives_reopening(tmp_path):
+    cache = AudioCache(min_plays=1)
+    cache.open(str(tmp_path))
+    cache.record_play("a")
+    path = write(tmp_path, "a.webm", 10)
+    cache.store("a", path)
+    reopened = AudioCache(min_plays=1)
+    reopened.open(str(tmp_path))
+    assert reopened.lookup("a") == path
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from utils import downloader
+from utils.admission import AdmissionController, Overloaded
+from utils.downloader import YTDLSource
+
+
+@pytest.fixture
+def extracted(monkeypatch):
+    "Records the urls extracted, in the order the extractions started"
+    urls = []
+    async def extract(url, download=False, fields=None, params=None):
+        urls.append(url)
+        await asyncio.sleep(0.01)
+        return {"webpage_url": url, "title": url, "url": url}
+    monkeypatch.setattr(downloader.engine, "extract", extract)
+    monkeypatch.setattr(downloader, "admission", AdmissionController(slots=1, per_guild=4, max_guild_queue=1))
+    return urls
+
+
+def test_joining_an_overloaded_extraction_retries_for_the_callers_guild(extracted):
+    async def run():
+        busy = asyncio.create_task(YTDLSource.extract_info("https://a.invalid/busy", guild_id=1))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(YTDLSource.extract_info("https://a.invalid/queued", guild_id=2, kind="bulk"))
+        await asyncio.sleep(0)
+        # Guild 2 has its one request waiting, so this one is turned away
+        rejected = asyncio.create_task(YTDLSource.extract_info("https://a.invalid/shared", guild_id=2, kind="bulk"))
+        joined = asyncio.create_task(YTDLSource.extract_info("https://a.invalid/shared", guild_id=3))
+        return await asyncio.gather(busy, queued, rejected, joined, return_exceptions=True)
+    busy, queued, rejected, joined = asyncio.run(run())
+    assert isinstance(rejected, Overloaded)
+    assert joined["webpage_url"] == "https://a.invalid/shared"
+
+
+def test_interactive_caller_moves_a_shared_bulk_extraction_forward(extracted):
+    downloader.admission.max_guild_queue = 5
+    async def run():
+        busy = asyncio.create_task(YTDLSource.extract_info("https://a.invalid/busy", guild_id=1))
+        await asyncio.sleep(0)
+        bulk = [asyncio.create_task(YTDLSource.extract_info(f"https://a.invalid/{index}", guild_id=2, kind="bulk")) for index in range(3)]
+        await asyncio.sleep(0)
+        joined = asyncio.create_task(YTDLSource.extract_info("https://a.invalid/2", guild_id=3))
+        await asyncio.gather(busy, joined, *bulk)
+    asyncio.run(run())
+    assert extracted == ["https://a.invalid/busy", "https://a.invalid/2", "https://a.invalid/0", "https://a.invalid/1"]
+
+
+def test_callers_needing_fresher_urls_do_not_share_an_extraction(extracted):
+    async def run():
+        await asyncio.gather(YTDLSource.extract_info("https://a.invalid/x", guild_id=1),
+                             YTDLSource.extract_info("https://a.invalid/x", guild_id=1))
+        await asyncio.gather(YTDLSource.extract_info("https://a.invalid/y", guild_id=1),
+                             YTDLSource.extract_info("https://a.invalid/y", guild_id=1, fresh_for=900))
+    asyncio.run(run())
+    assert extracted == ["https://a.invalid/x", "https://a.invalid/y", "https://a.invalid/y"]
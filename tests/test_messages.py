@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+from utils.messages import MessageScheduler
+from utils.scheduler import DeadlineScheduler
+
+
+class Channel:
+    "Records what is sent to it, along with the loop time"
+    def __init__(self, channel_id: int = 1):
+        self.id = channel_id
+        self.sent = []
+
+    async def send(self, **kwargs):
+        self.sent.append((asyncio.get_running_loop().time(), kwargs))
+        return SimpleNamespace(channel=self, id=len(self.sent))
+
+
+def test_updates_under_one_key_are_merged():
+    async def main():
+        channel = Channel()
+        messages = MessageScheduler(DeadlineScheduler(), rate=1, per=0.05)
+        messages.send(channel, content="first")
+        futures = [messages.send(channel, key="status", content=f"status {index}", embed=index) for index in range(3)]
+        futures.append(messages.send(channel, key="status", content="final"))
+        await asyncio.gather(*futures)
+        messages.scheduler.stop()
+        return [kwargs for _, kwargs in channel.sent], len(set(map(id, futures)))
+    sent, distinct_futures = asyncio.run(main())
+    assert sent == [{"content": "first"}, {"content": "final", "embed": 2}]
+    assert distinct_futures == 1
+
+
+def test_sends_beyond_the_bucket_wait_for_tokens():
+    async def main():
+        channel = Channel()
+        messages = MessageScheduler(DeadlineScheduler(), rate=2, per=0.1)
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(messages.send(channel, content=str(index)) for index in range(4)))
+        messages.scheduler.stop()
+        return [round(at-started, 2) for at, _ in channel.sent]
+    delays = asyncio.run(main())
+    assert delays[:2] == [0, 0]
+    # A token comes back every per/rate seconds
+    assert delays[2] >= 0.045 and delays[3] >= 0.095
+
+
+def test_channels_have_their_own_buckets():
+    async def main():
+        first, second = Channel(1), Channel(2)
+        messages = MessageScheduler(DeadlineScheduler(), rate=1, per=1)
+        await asyncio.wait_for(asyncio.gather(messages.send(first, content="a"), messages.send(second, content="b")), 0.1)
+        messages.scheduler.stop()
+        return len(first.sent), len(second.sent)
+    assert asyncio.run(main()) == (1, 1)
+
+
+def test_batched_lines_share_a_message():
+    async def main():
+        channel = Channel()
+        messages = MessageScheduler(DeadlineScheduler(), batch_delay=0.02)
+        render = lambda lines: {"content": "\n".join(lines)}
+        futures = [messages.send_batched(channel, "batch", f"line {index}", render) for index in range(3)]
+        await asyncio.gather(*futures)
+        messages.scheduler.stop()
+        return [kwargs for _, kwargs in channel.sent]
+    assert asyncio.run(main()) == [{"content": "line 0\nline 1\nline 2"}]
+
+
+def test_failed_updates_reach_their_future():
+    async def main():
+        async def fails(**kwargs):
+            raise ValueError("forbidden")
+        messages = MessageScheduler(DeadlineScheduler())
+        future = messages.update(1, fails, content="x")
+        try:
+            await future
+        except ValueError as exc:
+            return str(exc)
+        finally:
+            messages.scheduler.stop()
+    assert asyncio.run(main()) == "forbidden"
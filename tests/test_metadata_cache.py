@@ -0,0 +1,66 @@
+import time
+
+from utils.cache import MetadataCache, normalize_key
+
+
+def stream_url(expires_in: float):
+    return f"https://media.invalid/audio?expire={int(time.time()+expires_in)}"
+
+
+def test_urls_are_normalized_into_keys():
+    assert normalize_key("https://www.YouTube.com/watch/?v=abc&si=tracking&utm_source=x") == "https://youtube.com/watch?v=abc"
+    assert normalize_key("  Some   Query ") == "search:some query"
+
+
+def test_stream_urls_expire_before_their_metadata():
+    cache = MetadataCache()
+    cache.put("fresh", {"title": "fresh", "url": stream_url(3600)})
+    cache.put("stale", {"title": "stale", "url": stream_url(100)})
+    data, fresh = cache.get("fresh")
+    assert data["title"] == "fresh" and fresh
+    # Urls are given up on a margin ahead of their expire parameter
+    assert cache.get("stale")[0]["title"] == "stale" and cache.get("stale")[1] is False
+    # And only count as fresh when they stay usable for long enough
+    assert cache.get("fresh", fresh_for=3600)[1] is False
+    assert cache.get("missing") == (None, False)
+
+
+def test_metadata_expires():
+    cache = MetadataCache(metadata_ttl=-1)
+    cache.put("key", {"title": "old"})
+    assert cache.get("key") == (None, False)
+
+
+def test_least_recently_used_entries_are_dropped_from_memory():
+    cache = MetadataCache(max_entries=2)
+    cache.put("a", {"title": "a"})
+    cache.put("b", {"title": "b"})
+    cache.get("a")
+    cache.put("c", {"title": "c"})
+    assert list(cache._entries) == ["a", "c"]
+
+
+def test_the_file_is_kept_under_its_byte_budget(tmp_path):
+    cache = MetadataCache(max_entries=1, max_bytes=400)
+    cache.open(str(tmp_path / "metadata.sqlite3"))
+    for index in range(10):
+        cache.put(f"key{index}", {"title": "x"*50})
+    size, = cache._db.execute("SELECT SUM(size) FROM metadata").fetchone()
+    assert size <= 400
+    # The latest entries are still there after leaving memory
+    assert cache.get("key8")[0] == {"title": "x"*50}
+    assert cache.get("key0") == (None, False)
+    cache.close()
+
+
+def test_entries_survive_reopening(tmp_path):
+    path = str(tmp_path / "metadata.sqlite3")
+    cache = MetadataCache()
+    cache.open(path)
+    cache.put("key", {"title": "kept", "url": stream_url(3600)})
+    cache.close()
+    reopened = MetadataCache()
+    reopened.open(path)
+    data, fresh = reopened.get("key")
+    assert data["title"] == "kept" and fresh
+    reopened.close()
@@ -0,0 +1,41 @@
+import io
+from types import SimpleNamespace
+
+import discord.player
+import pytest
+
+from utils.downloader import OpusSource
+
+
+@pytest.fixture
+def ffmpeg_args(monkeypatch):
+    "Records the command lines FFmpeg would be spawned with"
+    spawned = []
+    def spawn(self, args, **kwargs):
+        spawned.append(args)
+        # Enough of a Popen for the source to kill it when it is cleaned up
+        return SimpleNamespace(stdout=io.BytesIO(), pid=0, returncode=0, kill=lambda: None, poll=lambda: 0)
+    monkeypatch.setattr(discord.player.FFmpegAudio, "_spawn_process", spawn)
+    return spawned
+
+
+def codec_of(args):
+    return args[args.index("-c:a")+1]
+
+
+def test_opus_at_full_volume_is_copied(ffmpeg_args):
+    OpusSource.create_audio("https://media.invalid/a.webm", {"acodec": "opus"}, 1.0)
+    assert codec_of(ffmpeg_args[0]) == "copy"
+    assert "-filter:a" not in ffmpeg_args[0]
+
+
+def test_volume_is_encoded(ffmpeg_args):
+    OpusSource.create_audio("https://media.invalid/a.webm", {"acodec": "opus"}, 0.5)
+    args = ffmpeg_args[0]
+    assert codec_of(args) == "libopus"
+    assert args[args.index("-filter:a")+1] == "volume=0.50"
+
+
+def test_other_codecs_are_encoded(ffmpeg_args):
+    OpusSource.create_audio("https://media.invalid/a.m4a", {"acodec": "mp4a.40.2"}, 1.0)
+    assert codec_of(ffmpeg_args[0]) == "libopus"
@@ -0,0 +1,22 @@
+import io
+import os
+
+from utils.printer import PrettyPrinter, RotatingFile, print_error
+
+
+def test_rotation_counts_bytes(tmp_path):
+    path = str(tmp_path / "bot.log")
+    log = RotatingFile(path, max_bytes=20, backup_count=1)
+    log.write("ééééé\n")
+    log.write("ééééé\n")
+    log.close()
+    assert os.path.getsize(path) <= 20
+    assert os.path.exists(f"{path}.1")
+
+
+def test_print_error_goes_to_the_default_printer(monkeypatch):
+    pipe = io.StringIO()
+    monkeypatch.setattr(PrettyPrinter, "_DEFAULT_PRINTER", None)
+    PrettyPrinter(target_pipe=pipe).make_default()
+    print_error("Player Error", ValueError("broken pipe"), guild=1)
+    assert pipe.getvalue().splitlines() == ["|+|Player Error", "   guild : 1", "   error : broken pipe"]
@@ -0,0 +1,29 @@
+from cogs.music import QueueManager
+from utils.downloader import QueueEntry
+
+
+def make_manager(count: int):
+    qm = QueueManager(None, None, None)
+    for index in range(count):
+        qm.queue.append(QueueEntry({"title": f"Track {index}", "webpage_url": f"https://media.invalid/{index}"}))
+    qm.queue.advance()
+    return qm
+
+
+def test_pages_of_a_shrunk_queue_show_its_last_page():
+    qm = make_manager(5)
+    pages = qm.get_pages(per_page=3)
+    assert len(pages) == 2
+    qm.queue.advance()
+    qm.queue.advance()
+    assert len(pages) == 1
+    assert [embed.title for embed in pages[1]] == [embed.title for embed in pages[0]]
+    assert len(list(pages)) == 1
+
+
+def test_entry_embeds_are_titled_per_position():
+    qm = make_manager(3)
+    first = qm.get_entry_embed(1)
+    qm.queue.advance()
+    second = qm.get_entry_embed(0)
+    assert (first.title, second.title) == ("Entry#1", "Now Playing")
@@ -0,0 +1,71 @@
+import asyncio
+
+from utils.scheduler import DeadlineScheduler
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_callbacks_run_in_deadline_order():
+    async def main():
+        scheduler = DeadlineScheduler()
+        calls = []
+        scheduler.schedule("late", 0.03, lambda: calls.append("late"))
+        scheduler.schedule("early", 0.01, lambda: calls.append("early"))
+        await asyncio.sleep(0.06)
+        scheduler.stop()
+        return calls
+    assert run(main()) == ["early", "late"]
+
+
+def test_scheduling_a_key_again_replaces_its_deadline():
+    async def main():
+        scheduler = DeadlineScheduler()
+        calls = []
+        scheduler.schedule("key", 0.01, lambda: calls.append("first"))
+        scheduler.schedule("key", 0.03, lambda: calls.append("second"))
+        await asyncio.sleep(0.02)
+        before = list(calls)
+        await asyncio.sleep(0.03)
+        scheduler.stop()
+        return before, calls, len(scheduler)
+    assert run(main()) == ([], ["second"], 0)
+
+
+def test_cancelled_keys_do_not_run():
+    async def main():
+        scheduler = DeadlineScheduler()
+        calls = []
+        scheduler.schedule("key", 0.01, lambda: calls.append("key"))
+        scheduler.cancel("key")
+        await asyncio.sleep(0.03)
+        scheduler.stop()
+        return calls
+    assert run(main()) == []
+
+
+def test_failing_callbacks_do_not_stop_the_others():
+    async def main():
+        scheduler = DeadlineScheduler()
+        calls = []
+        async def fails():
+            raise ValueError("broken")
+        scheduler.schedule("raises", 0, lambda: 1/0)
+        scheduler.schedule("coroutine", 0, fails)
+        scheduler.schedule("after", 0.01, lambda: calls.append("after"))
+        await asyncio.sleep(0.03)
+        scheduler.stop()
+        return calls
+    assert run(main()) == ["after"]
+
+
+def test_replaced_items_do_not_pile_up():
+    async def main():
+        scheduler = DeadlineScheduler()
+        for _ in range(1000):
+            scheduler.schedule("key", 10, lambda: None)
+        size = len(scheduler._heap)
+        scheduler.stop()
+        return size
+    assert run(main()) <= 2+64+1
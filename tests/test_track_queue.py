@@ -0,0 +1,92 @@
+import pytest
+
+from utils.downloader import QueueEntry
+from utils.track_queue import QueueFull, TrackQueue
+
+
+def make_queue(count: int, **options):
+    queue = TrackQueue(**options)
+    queue.extend(QueueEntry({"title": str(index)}) for index in range(count))
+    return queue
+
+
+def titles(queue: TrackQueue):
+    return [entry.title for entry in queue]
+
+
+def test_advance_past_the_end_leaves_no_current_entry():
+    queue = make_queue(2)
+    assert queue.advance().title == "0"
+    assert queue.advance().title == "1"
+    assert queue.advance() is None
+    assert len(queue) == 0
+    # Going back from the end plays the last entry again
+    assert queue.previous().title == "1"
+    assert titles(queue) == ["1"]
+
+
+def test_previous_at_the_start_does_nothing():
+    queue = make_queue(2)
+    assert queue.previous() is None
+    queue.advance()
+    assert queue.previous() is None
+    assert titles(queue) == ["0", "1"]
+
+
+def test_previous_puts_the_current_entry_up_next():
+    queue = make_queue(3)
+    queue.advance()
+    queue.advance()
+    assert queue.previous().title == "0"
+    assert titles(queue) == ["0", "1", "2"]
+
+
+def test_insert_clamps_positions_out_of_range():
+    queue = make_queue(2)
+    queue.insert(0, QueueEntry({"title": "first"}))
+    queue.insert(99, QueueEntry({"title": "last"}))
+    assert titles(queue) == ["first", "0", "1", "last"]
+
+
+def test_move_clamps_the_new_position_and_checks_the_old_one():
+    queue = make_queue(3)
+    queue.move(1, 99)
+    assert titles(queue) == ["1", "2", "0"]
+    queue.move(3, -5)
+    assert titles(queue) == ["0", "1", "2"]
+    with pytest.raises(IndexError):
+        queue.move(4, 1)
+    with pytest.raises(IndexError):
+        queue.remove(0)
+
+
+def test_upcoming_entries_are_capped():
+    queue = make_queue(3, max_upcoming=3)
+    assert queue.room == 0
+    with pytest.raises(QueueFull):
+        queue.append(QueueEntry({"title": "over"}))
+    with pytest.raises(QueueFull):
+        queue.insert(1, QueueEntry({"title": "over"}))
+    # The current entry does not count against the cap
+    queue.advance()
+    queue.append(QueueEntry({"title": "3"}))
+    assert titles(queue) == ["0", "1", "2", "3"]
+
+
+def test_history_keeps_the_last_entries_only():
+    queue = make_queue(5, max_history=2)
+    for _ in range(5):
+        queue.advance()
+    assert [entry.title for entry in queue.history] == ["2", "3"]
+    assert queue.previous().title == "3"
+    assert queue.previous().title == "2"
+    assert queue.previous() is None
+
+
+def test_every_change_bumps_the_version():
+    queue = make_queue(3)
+    versions = [queue.version]
+    for change in (queue.advance, queue.advance, queue.shuffle, lambda: queue.move(1, 2), lambda: queue.remove(1), queue.previous, queue.clear):
+        change()
+        versions.append(queue.version)
+    assert versions == sorted(set(versions))
@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from utils import metrics
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController:
+    """Hands out extraction slots across guilds by weighted fair queuing.
+
+    Every waiting request gets a virtual finish tag, its guild's previous
+    tag (or the current virtual time, if later) plus the inverse of its
+    weight. Free slots go to the lowest tag among guilds below their
+    concurrency limit. A guild queueing fifty bulk items therefore only
+    gets its share of the slots, and interactive requests, weighing more,
+    overtake bulk work queued before them without starving it.
+
+    A request is rejected with Overloaded right away when its guild already
+    has `max_guild_queue` requests waiting or `max_queue` wait overall, so
+    overload shows up as a quick message instead of a long wait.
+    """
+    WEIGHTS = {"interactive": 8, "bulk": 1}
+
+    def __init__(self, slots: int = 4, per_guild: int = 2, max_guild_queue: int = 25, max_queue: int = 500):
+        self.slots = slots
+        self.per_guild = per_guild
+        self.max_guild_queue = max_guild_queue
+        self.max_queue = max_queue
+        self._in_use = 0
+        self._active: dict[Optional[int], int] = {}
+        self._waiting: dict[Optional[int], int] = {}
+        self._last_tags: dict[Optional[int], float] = {}
+        self._virtual_time = 0.0
+        self._heap: list[tuple[float, int, Optional[int], asyncio.Future]] = []
+        self._counter = itertools.count()
+        # Heap item and kind of every waiting task, for promote
+        self._waiters: dict[asyncio.Task, tuple[tuple, str]] = {}
+
+    @property
+    def waiting(self):
+        return sum(self._waiting.values())
+
+    @asynccontextmanager
+    async def admit(self, guild_id: Optional[int], kind: str = "interactive"):
+        "Holds an extraction slot for the guild while the block runs, None is the guild of background work"
+        await self._acquire(guild_id, kind)
+        try:
+            yield
+        finally:
+            self._release(guild_id)
+
+    async def _acquire(self, guild_id: Optional[int], kind: str):
+        if not self._heap and self._in_use < self.slots and self._active.get(guild_id, 0) < self.per_guild:
+            self._grant(guild_id)
+            return
+        if self._waiting.get(guild_id, 0) >= self.max_guild_queue:
+            metrics.admission_rejections.inc("guild")
+            raise Overloaded("This server has too many requests waiting, please try again in a moment.")
+        if self.waiting >= self.max_queue:
+            metrics.admission_rejections.inc("overall")
+            raise Overloaded("The bot is too busy right now, please try again in a moment.")
+        tag = max(self._virtual_time, self._last_tags.get(guild_id, 0.0)) + 1/self.WEIGHTS[kind]
+        self._last_tags[guild_id] = tag
+        self._waiting[guild_id] = self._waiting.get(guild_id, 0)+1
+        future = asyncio.get_running_loop().create_future()
+        item = (tag, next(self._counter), guild_id, future)
+        heapq.heappush(self._heap, item)
+        task = asyncio.current_task()
+        self._waiters[task] = (item, kind)
+        # Waiters of guilds at their limit may hold up the heap while slots are free
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted right as the waiter got cancelled
+                self._release(guild_id)
+            else:
+                self._unwait(guild_id)
+                self._dispatch()
+            raise
+        finally:
+            del self._waiters[task]
+
+    def promote(self, task: asyncio.Task, kind: str):
+        "Moves the request task waits with up to where a new kind request of an idle guild would queue"
+        if task not in self._waiters:
+            return
+        item, old_kind = self._waiters[task]
+        if self.WEIGHTS[kind] <= self.WEIGHTS[old_kind] or item not in self._heap:
+            return
+        tag, counter, guild_id, future = item
+        promoted = (min(tag, self._virtual_time+1/self.WEIGHTS[kind]), counter, guild_id, future)
+        self._heap.remove(item)
+        heapq.heapify(self._heap)
+        heapq.heappush(self._heap, promoted)
+        self._waiters[task] = (promoted, kind)
+
+    def _grant(self, guild_id: Optional[int]):
+        self._in_use += 1
+        self._active[guild_id] = self._active.get(guild_id, 0)+1
+
+    def _unwait(self, guild_id: Optional[int]):
+        self._waiting[guild_id] -= 1
+        if not self._waiting[guild_id]:
+            del self._waiting[guild_id]
+            self._forget(guild_id)
+
+    def _forget(self, guild_id: Optional[int]):
+        # Idle guilds start over from the virtual time, so their tags do not pile up
+        if guild_id not in self._active and guild_id not in self._waiting:
+            self._last_tags.pop(guild_id, None)
+
+    def _release(self, guild_id: Optional[int]):
+        self._in_use -= 1
+        self._active[guild_id] -= 1
+        if not self._active[guild_id]:
+            del self._active[guild_id]
+            self._forget(guild_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        blocked = []
+        while self._heap and self._in_use < self.slots:
+            item = heapq.heappop(self._heap)
+            tag, _, guild_id, future = item
+            if future.cancelled():
+                continue
+            if self._active.get(guild_id, 0) >= self.per_guild:
+                blocked.append(item)
+                continue
+            self._grant(guild_id)
+            self._unwait(guild_id)
+            self._virtual_time = max(self._virtual_time, tag)
+            future.set_result(None)
+        for item in blocked:
+            heapq.heappush(self._heap, item)
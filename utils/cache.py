@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+TRACKING_PARAMS = {'si', 'feature', 'pp', 'ab_channel', 'start_radio', 'pbjreload'}
+
+
+def normalize_key(query: str):
+    """Normalizes an url or a search query into a cache key."""
+    query = query.strip()
+    parts = urlsplit(query)
+    if parts.scheme in ('http', 'https') and parts.netloc:
+        netloc = parts.netloc.lower()
+        if netloc.startswith('www.'):
+            netloc = netloc[4:]
+        params = sorted((k, v) for k, v in parse_qsl(parts.query) if k not in TRACKING_PARAMS and not k.startswith('utm_'))
+        return urlunsplit(('https', netloc, parts.path.rstrip('/'), urlencode(params), ''))
+    return 'search:' + ' '.join(query.casefold().split())
+
+
+def stream_url_expiry(url: Optional[str], default_ttl: float, margin: float = 300):
+    """Returns the timestamp at which a direct media url should be considered stale."""
+    if url:
+        expire = dict(parse_qsl(urlsplit(url).query)).get('expire')
+        if expire is not None and expire.isdigit():
+            return int(expire) - margin
+    return time.time() + default_ttl
+
+
+class MetadataCache:
+    """LRU cache of extracted metadata, optionally backed by a SQLite file.
+
+    Metadata (title, uploader, duration, ...) lives for `metadata_ttl` seconds,
+    while the direct media url is tracked separately as it expires much sooner.
+    `get` reports whether the stored url is still usable, so callers can skip
+    extraction entirely or only refresh the stream url.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 32*1024*1024, metadata_ttl: float = 7*24*60*60, stream_ttl: float = 60*60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.metadata_ttl = metadata_ttl
+        self.stream_ttl = stream_ttl
+        self._entries: OrderedDict[str, Tuple[dict, float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def open(self, path: str):
+        with self._lock:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, data TEXT NOT NULL, stored_at REAL NOT NULL, url_expires_at REAL NOT NULL, last_access REAL NOT NULL, size INTEGER NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS metadata_last_access ON metadata (last_access)")
+            self._db.execute("DELETE FROM metadata WHERE stored_at < ?", (time.time()-self.metadata_ttl,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get(self, key: str, fresh_for: float = 0):
+        "Returns a tuple of (data, stream_url_fresh), data is None on a miss. The url has to stay fresh for `fresh_for` seconds."
+        now = time.time()
+        with self._lock:
+            record = self._entries.get(key)
+            if record is None and self._db is not None:
+                row = self._db.execute("SELECT data, stored_at, url_expires_at FROM metadata WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    record = (json.loads(row[0]), row[1], row[2])
+                    self._remember(key, record)
+            if record is None or record[1]+self.metadata_ttl < now:
+                return None, False
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute("UPDATE metadata SET last_access = ? WHERE key = ?", (now, key))
+                self._db.commit()
+            return dict(record[0]), record[2] > now+fresh_for
+
+    def put(self, key: str, data: dict):
+        now = time.time()
+        record = (dict(data), now, stream_url_expiry(data.get('url'), self.stream_ttl))
+        with self._lock:
+            self._remember(key, record)
+            if self._db is not None:
+                serialized = json.dumps(record[0])
+                self._db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)", (key, serialized, now, record[2], now, len(serialized)))
+                self._evict_persisted()
+                self._db.commit()
+
+    def _remember(self, key: str, record: Tuple[dict, float, float]):
+        self._entries[key] = record
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _evict_persisted(self):
+        total, = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM metadata").fetchone()
+        if total <= self.max_bytes:
+            return
+        # Drops least recently used rows until the file is back under 90% of its budget
+        excess = total - int(self.max_bytes*0.9)
+        stale = []
+        for key, size in self._db.execute("SELECT key, size FROM metadata ORDER BY last_access"):
+            if excess <= 0: break
+            stale.append((key,))
+            excess -= size
+        self._db.executemany("DELETE FROM metadata WHERE key = ?", stale)
+
+
+class AudioCache:
+    """Size capped directory of downloaded audio files, keyed like MetadataCache.
+
+    Plays are counted per track and tracks reaching `min_plays` are worth
+    downloading. Once `max_bytes` is exceeded the least played files go
+    first, the least recently played ones among equally played files.
+    Failed downloads, and files larger than the whole cache, are not tried
+    again for `retry_after` seconds. Disabled until `open` is given a
+    directory.
+    """
+    def __init__(self, max_bytes: int = 1024*1024*1024, min_plays: int = 3, forget_after: float = 30*24*60*60, retry_after: float = 24*60*60):
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.forget_after = forget_after
+        self.retry_after = retry_after
+        self.directory: Optional[str] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._files: dict[str, str] = {}
+        self._downloading: set[str] = set()
+
+    @property
+    def enabled(self):
+        return self._db is not None
+
+    def open(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self.directory = directory
+            self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS audio (key TEXT PRIMARY KEY, path TEXT, size INTEGER NOT NULL DEFAULT 0, plays INTEGER NOT NULL DEFAULT 0, last_access REAL NOT NULL, failed_at REAL)")
+            # Indexes written before failed downloads were recorded lack the column
+            if "failed_at" not in [column[1] for column in self._db.execute("PRAGMA table_info(audio)")]:
+                self._db.execute("ALTER TABLE audio ADD COLUMN failed_at REAL")
+            # Play counts of tracks which never made it into the cache are not kept forever
+            self._db.execute("DELETE FROM audio WHERE path IS NULL AND last_access < ?", (time.time()-self.forget_after,))
+            for key, path in self._db.execute("SELECT key, path FROM audio WHERE path IS NOT NULL").fetchall():
+                if os.path.exists(path):
+                    self._files[key] = path
+                else:
+                    self._db.execute("UPDATE audio SET path = NULL, size = 0 WHERE key = ?", (key,))
+            self._db.commit()
+
+    def lookup(self, key: str):
+        "Returns the local file of a track, or None when it is not cached."
+        return self._files.get(key)
+
+    def record_play(self, key: str):
+        "Counts a play, returns True when the track should be downloaded now."
+        if not self.enabled:
+            return False
+        with self._lock:
+            self._db.execute("INSERT INTO audio (key, plays, last_access) VALUES (?, 1, ?) ON CONFLICT(key) DO UPDATE SET plays = plays + 1, last_access = excluded.last_access", (key, time.time()))
+            self._db.commit()
+            plays, failed_at = self._db.execute("SELECT plays, failed_at FROM audio WHERE key = ?", (key,)).fetchone()
+            if plays < self.min_plays or key in self._files or key in self._downloading:
+                return False
+            if failed_at is not None and failed_at+self.retry_after > time.time():
+                return False
+            self._downloading.add(key)
+            return True
+
+    def store(self, key: str, path: Optional[str]):
+        "Registers a finished download, a None path marks it as failed."
+        with self._lock:
+            self._downloading.discard(key)
+            size = os.path.getsize(path) if path is not None and os.path.exists(path) else None
+            if size is not None and size > self.max_bytes:
+                # Keeping it would push every other file out and still go over the budget
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size = None
+            if size is None:
+                self._db.execute("UPDATE audio SET failed_at = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+                return
+            self._files[key] = path
+            self._db.execute("UPDATE audio SET path = ?, size = ?, failed_at = NULL WHERE key = ?", (path, size, key))
+            self._evict(keep=key)
+            self._db.commit()
+
+    def _evict(self, keep: str):
+        total, = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM audio WHERE path IS NOT NULL").fetchone()
+        if total <= self.max_bytes:
+            return
+        for key, path, size in self._db.execute("SELECT key, path, size FROM audio WHERE path IS NOT NULL ORDER BY plays, last_access").fetchall():
+            if total <= self.max_bytes: break
+            if key == keep: continue
+            self._files.pop(key, None)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._db.execute("UPDATE audio SET path = NULL, size = 0 WHERE key = ?", (key,))
+            total -= size
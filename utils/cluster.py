@@ -0,0 +1,152 @@
+import asyncio
+import multiprocessing
+import time
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Optional
+
+import requests
+
+
+def fetch_shard_count(token: str):
+    "Asks discord for the recommended shard count of the bot"
+    response = requests.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}, timeout=10)
+    response.raise_for_status()
+    return response.json()["shards"]
+
+
+def split_shards(shard_count: int, clusters: int):
+    "Spreads shard ids over the clusters, as evenly as possible"
+    return [list(range(cluster, shard_count, clusters)) for cluster in range(clusters)]
+
+
+class ClusterLink:
+    """Worker side of the pipe to the ClusterSupervisor.
+
+    Periodically reports this worker's stats and keeps the latest totals of
+    the whole cluster in `totals`.
+    """
+    def __init__(self, bot, conn: Connection, cluster_id: int, interval: float = 15):
+        self.bot = bot
+        self.conn = conn
+        self.cluster_id = cluster_id
+        self.interval = interval
+        self.totals: Optional[dict] = None
+
+    def collect(self):
+        music_queue = self.bot.get_cog('MusicQueue')
+        return {'cluster': self.cluster_id,
+                'shards': list(self.bot.shard_ids or []),
+                'guilds': len(self.bot.guilds),
+                'latency': self.bot.latency,
+                'voice': len(self.bot.voice_clients),
+                'queues': music_queue.get_session_counts()['queues'] if music_queue is not None else 0}
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            self.conn.send(("stats", self.collect()))
+            while self.conn.poll():
+                kind, payload = self.conn.recv()
+                if kind == "totals":
+                    self.totals = payload
+            await asyncio.sleep(self.interval)
+
+
+def run_worker(create_bot: Callable, development: bool, cluster_id: int, shard_ids: list, shard_count: int, conn: Connection):
+    bot, token = create_bot(development, cluster_id=cluster_id, shard_ids=shard_ids, shard_count=shard_count)
+    bot.CLUSTER = ClusterLink(bot, conn, cluster_id)
+    bot.loop.create_task(bot.CLUSTER.run())
+    bot.run(token)
+
+
+class ClusterSupervisor:
+    """Runs the bot as one process per cluster, each over its own slice of shards.
+
+    Collects the stats every worker reports, sends the aggregated totals back
+    to all of them, and restarts workers which crash. Workers closing cleanly
+    are not restarted, `run` returns once all of them did.
+    """
+    def __init__(self, create_bot: Callable, development: bool, clusters: int, shard_count: int, restart_delay: float = 10):
+        self.create_bot = create_bot
+        self.development = development
+        self.shard_count = shard_count
+        self.shard_slices = split_shards(shard_count, clusters)
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: dict[int, multiprocessing.process.BaseProcess] = {}
+        self.conns: dict[int, Connection] = {}
+        self.started_at: dict[int, float] = {}
+        self.stats: dict[int, dict] = {}
+
+    def start_worker(self, cluster_id: int):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=run_worker, name=f"cluster-{cluster_id}",
+                                       args=(self.create_bot, self.development, cluster_id, self.shard_slices[cluster_id], self.shard_count, child_conn))
+        process.start()
+        child_conn.close()
+        self.processes[cluster_id] = process
+        self.conns[cluster_id] = parent_conn
+        self.started_at[cluster_id] = time.monotonic()
+        self.stats.pop(cluster_id, None)
+
+    def totals(self):
+        stats = list(self.stats.values())
+        return {'clusters': len(self.processes),
+                'shards': self.shard_count,
+                'guilds': sum(stat['guilds'] for stat in stats),
+                'voice': sum(stat['voice'] for stat in stats),
+                'queues': sum(stat['queues'] for stat in stats),
+                'latency': sum(stat['latency'] for stat in stats)/len(stats) if stats else 0.0}
+
+    def broadcast_totals(self):
+        totals = self.totals()
+        for conn in self.conns.values():
+            try:
+                conn.send(("totals", totals))
+            except (BrokenPipeError, OSError):
+                pass
+
+    def run(self):
+        for cluster_id in range(len(self.shard_slices)):
+            self.start_worker(cluster_id)
+        try:
+            while self.processes:
+                # Exited workers are only looked at again once they may be restarted
+                alive = [cluster_id for cluster_id, process in self.processes.items() if process.is_alive()]
+                by_handle = {self.conns[cluster_id]: cluster_id for cluster_id in alive}
+                by_handle.update({self.processes[cluster_id].sentinel: cluster_id for cluster_id in alive})
+                ready = wait(list(by_handle), timeout=self.restart_delay)
+                received = False
+                for handle in ready:
+                    cluster_id = by_handle[handle]
+                    if isinstance(handle, Connection):
+                        try:
+                            kind, payload = handle.recv()
+                        except (EOFError, OSError):
+                            continue
+                        if kind == "stats":
+                            self.stats[cluster_id] = payload
+                            received = True
+                if received:
+                    self.broadcast_totals()
+                self.restart_exited()
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+
+    def restart_exited(self):
+        for cluster_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if process.exitcode == 0:
+                print(f"Cluster {cluster_id} closed.")
+                del self.processes[cluster_id]
+                self.conns.pop(cluster_id).close()
+                self.stats.pop(cluster_id, None)
+                continue
+            # Workers crashing right after start are restarted no faster than restart_delay
+            if time.monotonic()-self.started_at[cluster_id] < self.restart_delay:
+                continue
+            print(f"Cluster {cluster_id} exited with code {process.exitcode}, restarting.")
+            self.conns.pop(cluster_id).close()
+            self.start_worker(cluster_id)
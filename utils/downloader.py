@@ -1,10 +1,16 @@
 import asyncio
-import yt_dlp
 import discord
 import json
+import threading
+import time
+from collections import deque
 
-# Suppress noise about console usage from errors
-yt_dlp.utils.bug_reports_message = lambda: ""
+from utils.cache import MetadataCache, AudioCache, normalize_key, stream_url_expiry
+from utils.admission import AdmissionController, Overloaded
+from utils.printer import print_error
+from utils.extractor import ExtractionEngine
+from utils.voice_workers import VoiceWorkerPool, WorkerAudio
+from utils import metrics
 
 
 ytdl_format_options = {
@@ -28,7 +34,85 @@ ffmpeg_options = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+# Every worker process of the engine builds its own YoutubeDL from these options
+engine = ExtractionEngine(ytdl_format_options)
+# Orders extractions across guilds, bot.setup matches its slots to the engine
+admission = AdmissionController(slots=engine.max_in_flight)
+
+# Fields kept on queued entries, the rest of the extracted info is discarded
+METADATA_FIELDS = ("title", "url", "webpage_url", "uploader", "duration", "view_count", "like_count", "thumbnail", "acodec")
+
+# "pcm" decodes in FFmpeg and scales volume in python before encoding to opus in process,
+# "opus" lets FFmpeg hand over opus packets directly, see OpusSource,
+# "worker" decodes, scales and encodes in voice worker processes, see WorkerSource
+AUDIO_MODES = ("pcm", "opus", "worker")
+
+# Size of one 20ms frame of 48KHz stereo PCM
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+
+# Memory only until bot.setup opens its backing file
+metadata_cache = MetadataCache()
+
+# Disabled unless bot.setup is given AUDIO_CACHE_DIR
+audio_cache = AudioCache()
+# Audio cache downloads run on their own workers with a longer timeout, so a download
+# timing out does not terminate the workers of the extractions users wait on
+download_engine = ExtractionEngine(ytdl_format_options, workers=1, max_in_flight=1, timeout=10*60)
+
+# Only started by the "worker" audio mode, bot.setup sizes it
+voice_pool = VoiceWorkerPool()
+
+
+def before_options_for(location: str):
+    "Reconnect options only apply to remote streams, FFmpeg rejects them for local files"
+    return ffmpeg_options["before_options"] if location.startswith(("http://", "https://")) else ""
+
+
+# Keeps fire and forget tasks referenced until they finish
+_background_tasks: set[asyncio.Task] = set()
+# Extractions in flight by (normalized url, stream, fresh_for), shared by concurrent callers
+_in_flight: dict[tuple[str, bool, float], asyncio.Task] = {}
+
+
+def _finish_in_flight(key: tuple[str, bool, float], task: asyncio.Task):
+    if _in_flight.get(key) is task:
+        del _in_flight[key]
+    # Every waiter may have given up, the error is theirs to see and not worth a warning
+    if not task.cancelled():
+        task.exception()
+
+
+def note_play(data: dict, *, loop=None):
+    "Schedules record_play in the background"
+    if not audio_cache.enabled:
+        return
+    loop = loop or asyncio.get_event_loop()
+    task = loop.create_task(record_play(data, loop=loop))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def record_play(data: dict, *, loop=None):
+    "Counts a play of the track, downloading it into the audio cache once it is played often enough"
+    if not audio_cache.enabled or not data.get("webpage_url"):
+        return
+    loop = loop or asyncio.get_event_loop()
+    key = normalize_key(data["webpage_url"])
+    if not await loop.run_in_executor(None, audio_cache.record_play, key):
+        return
+    try:
+        downloaded = await download_engine.extract(data["webpage_url"], download=True, fields=("webpage_url",), params={"paths": {"home": audio_cache.directory}})
+        path = downloaded["filename"]
+    except Exception as exc:
+        print_error("Audio Cache Download Error", exc, url=data["webpage_url"])
+        path = None
+    await loop.run_in_executor(None, audio_cache.store, key, path)
+
+
+def stream_location(data: dict):
+    "Where to play extracted data from, the audio cache's file of the track if there is one, else its stream url"
+    local_path = audio_cache.lookup(normalize_key(data["webpage_url"])) if data.get("webpage_url") else None
+    return local_path or data["url"]
 
 
 class YTDLSource(discord.PCMVolumeTransformer):
@@ -39,9 +123,18 @@ class YTDLSource(discord.PCMVolumeTransformer):
 
         self.title = data.get("title")
         self.url = data.get("url")
-        self.humanized_data = {'duration': self.format_duration(data.get('duration', -1)), 
-                               'views': self.format_numbers(data.get('view_count', -1)), 
-                               'likes': self.format_numbers(data.get('like_count', -1))}
+        self.humanized_data = self.humanize(data)
+    
+    @classmethod
+    def humanize(cls, data: dict):
+        return {'duration': cls.format_duration(cls._get_number(data, 'duration')), 
+                'views': cls.format_numbers(cls._get_number(data, 'view_count')), 
+                'likes': cls.format_numbers(cls._get_number(data, 'like_count'))}
+    
+    @staticmethod
+    def _get_number(data: dict, key: str):
+        value = data.get(key)
+        return -1 if value is None else value
     
     def create_discord_embed(self, **kwargs):
         embed = discord.Embed(title="Now playing", **kwargs)
@@ -81,16 +174,355 @@ class YTDLSource(discord.PCMVolumeTransformer):
         hundred_mils, mils = divmod(mils, 100)
         return f"{bils}B" if hundred_mils == 0 else f"{bils}.{hundred_mils}B"
 
-    @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
+    @staticmethod
+    async def extract_info(url, *, loop=None, stream=False, guild_id=None, kind="interactive", fresh_for: float = 0):
+        """Extracts url, concurrent calls for the same url share a single extraction.
+        
+        Callers get their own copy of the data. Errors reach every caller, and
+        a caller being cancelled does not cancel the extraction for the others.
+        Extractions wait for admission as `kind` work of the guild, and may
+        raise Overloaded. Interactive callers joining a bulk extraction move
+        it forward, and a shared extraction turned away for the guild which
+        started it is tried again for the caller's. A cached stream url is
+        only used when it stays fresh for another `fresh_for` seconds."""
         loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(
-            None, lambda: ytdl.extract_info(url, download=not stream)
-        )
+        key = (normalize_key(url), stream, fresh_for)
+        for attempt in range(2):
+            task = _in_flight.get(key)
+            joined = task is not None
+            if joined:
+                metrics.extractions_coalesced.inc()
+                admission.promote(task, kind)
+            else:
+                task = loop.create_task(YTDLSource._extract_info(url, loop=loop, stream=stream, guild_id=guild_id, kind=kind, fresh_for=fresh_for))
+                _in_flight[key] = task
+                task.add_done_callback(lambda task: _finish_in_flight(key, task))
+            try:
+                return dict(await asyncio.shield(task))
+            except Overloaded:
+                if not joined or attempt:
+                    raise
+                # Its done callback may not have run yet, the retry must not join it again
+                if _in_flight.get(key) is task:
+                    del _in_flight[key]
+    
+    @staticmethod
+    async def _extract_info(url, *, loop, stream, guild_id, kind, fresh_for):
+        if not stream:
+            async with admission.admit(guild_id, kind):
+                return await engine.extract(url, download=True, fields=METADATA_FIELDS)
         
-        if "entries" in data:
-            # Takes the first item from a playlist
-            data = data["entries"][0]
+        key = normalize_key(url)
+        cached, url_fresh = await loop.run_in_executor(None, metadata_cache.get, key, fresh_for)
+        if cached is not None and url_fresh:
+            metrics.metadata_cache_lookups.inc("hit")
+            return cached
+        metrics.metadata_cache_lookups.inc("miss" if cached is None else "stale")
+        
+        # Metadata is still known, only the stream url has to be resolved again
+        target = cached["webpage_url"] if cached is not None and cached.get("webpage_url") else url
+        async with admission.admit(guild_id, kind):
+            data = await engine.extract(target, fields=METADATA_FIELDS)
+        
+        await loop.run_in_executor(None, metadata_cache.put, key, data)
+        if data["webpage_url"] and normalize_key(data["webpage_url"]) != key:
+            await loop.run_in_executor(None, metadata_cache.put, normalize_key(data["webpage_url"]), data)
+        return data
+    
+    @classmethod
+    async def from_url(cls, url, *, loop=None, stream=False, guild_id=None):
+        with metrics.source_create_seconds.labels("pcm").time():
+            data = await cls.extract_info(url, loop=loop, stream=stream, guild_id=guild_id)
+            filename = stream_location(data) if stream else data["filename"]
+            with metrics.ffmpeg_spawn_seconds.time():
+                audio = discord.FFmpegPCMAudio(filename, before_options=before_options_for(filename), options=ffmpeg_options["options"])
+            return cls(audio, data=data)
+
+
+class OpusSource(discord.AudioSource):
+    """Plays FFmpeg's opus output without decoding or encoding in the bot process.
+
+    Opus streams are copied as is while the volume is 100%, otherwise the
+    volume is applied by an FFmpeg filter. Setting `volume` restarts FFmpeg
+    at the current position.
+    """
+    def __init__(self, original: discord.AudioSource, *, data: dict, volume: float = 1.0, position: float = 0.0, location: str | None = None):
+        self.original = original
+        self.data = data
+
+        self.title = data.get("title")
+        self.url = data.get("url")
+        # Where FFmpeg reads from when restarted, a cached file or the stream url
+        self.location = location or self.url
+        self.humanized_data = YTDLSource.humanize(data)
+        self._volume = volume
+        self._position = position
+        self._frames = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create_audio(location: str, data: dict, volume: float = 1.0, position: float = 0.0):
+        copy = volume == 1.0 and data.get("acodec") == "opus"
+        before_options = before_options_for(location) + (f" -ss {position:.2f}" if position else "")
+        options = ffmpeg_options["options"] + ("" if copy else f" -filter:a volume={volume:.2f}")
+        with metrics.ffmpeg_spawn_seconds.time():
+            # pycord copies the stream for any opus codec name, None has it encode with libopus
+            return discord.FFmpegOpusAudio(location, codec="copy" if copy else None, before_options=before_options, options=options)
+
+    create_discord_embed = YTDLSource.create_discord_embed
+
+    @property
+    def elapsed(self):
+        # Every opus packet carries 20ms of audio
+        return self._position + self._frames*discord.opus.Encoder.FRAME_LENGTH/1000
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        value = max(value, 0.0)
+        if value == self._volume:
+            return
+        restarted = self.create_audio(self.location, self.data, value, self.elapsed)
+        with self._lock:
+            old, self.original = self.original, restarted
+            self._position, self._frames = self.elapsed, 0
+            self._volume = value
+        old.cleanup()
+
+    def read(self):
+        with self._lock:
+            frame = self.original.read()
+            if frame:
+                self._frames += 1
+        return frame
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    @classmethod
+    async def from_url(cls, url, *, loop=None, stream=False, volume: float = 1.0, guild_id=None):
+        with metrics.source_create_seconds.labels("opus").time():
+            data = await YTDLSource.extract_info(url, loop=loop, stream=stream, guild_id=guild_id)
+            filename = stream_location(data) if stream else data["filename"]
+            return cls(cls.create_audio(filename, data, volume), data=data, volume=volume, location=filename)
+
+
+class WorkerSource(discord.AudioSource):
+    """Plays audio decoded, scaled and encoded by a voice worker.
+
+    Volume changes are sent to the worker and apply within a batch of
+    packets, without restarting FFmpeg.
+    """
+    def __init__(self, original: WorkerAudio, *, data: dict, volume: float = 1.0):
+        self.original = original
+        self.data = data
+
+        self.title = data.get("title")
+        self.url = data.get("url")
+        self.humanized_data = YTDLSource.humanize(data)
+        # Prepared audio may have been started at an older volume
+        if original.volume != volume:
+            original.volume = volume
+
+    @staticmethod
+    def create_audio(location: str, volume: float = 1.0):
+        return voice_pool.open(location, before_options=before_options_for(location), options=ffmpeg_options["options"], volume=volume)
+
+    create_discord_embed = YTDLSource.create_discord_embed
+
+    @property
+    def volume(self):
+        return self.original.volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self.original.volume = value
+
+    def read(self):
+        return self.original.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    @classmethod
+    async def from_url(cls, url, *, loop=None, stream=False, volume: float = 1.0, guild_id=None):
+        with metrics.source_create_seconds.labels("worker").time():
+            data = await YTDLSource.extract_info(url, loop=loop, stream=stream, guild_id=guild_id)
+            filename = stream_location(data) if stream else data["filename"]
+            audio = cls.create_audio(filename, volume)
+            # The first packets are waited for here, so the player does not start on silence
+            await (loop or asyncio.get_event_loop()).run_in_executor(None, audio.fill, audio.low_water)
+            return cls(audio, data=data, volume=volume)
+
+
+class BufferedAudio(discord.AudioSource):
+    "Audio source which serves frames read ahead by `fill` before reading from the original source."
+    def __init__(self, original: discord.AudioSource):
+        self.original = original
+        self.frames: deque[bytes] = deque()
+
+    def fill(self, count: int):
+        # Blocks until the frames are read, run it in an executor
+        while len(self.frames) < count:
+            frame = self.original.read()
+            if not frame:
+                break
+            self.frames.append(frame)
+
+    def read(self):
+        if self.frames:
+            return self.frames.popleft()
+        return self.original.read()
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.frames.clear()
+        self.original.cleanup()
+
+
+class QueueEntry:
+    """Compact metadata record of a queued track.
+
+    The FFmpeg backed source is only built by `create_source` when the entry
+    is about to be played, and is dropped again by `release`. `prepare` may
+    start the decoder ahead of time for entries that are up next.
+    """
+    __slots__ = METADATA_FIELDS + ("expires_at", "source", "prepared", "prepared_for")
+
+    def __init__(self, data: dict):
+        for field in METADATA_FIELDS:
+            setattr(self, field, data.get(field))
+        # When the stream url goes stale, None while there is none
+        self.expires_at: float | None = None
+        self._track_expiry()
+        self.source: YTDLSource | OpusSource | None = None
+        self.prepared: BufferedAudio | None = None
+        # Audio mode and volume the prepared audio was started with
+        self.prepared_for: tuple | None = None
+
+    @classmethod
+    async def from_url(cls, url, *, loop=None, guild_id=None, kind="interactive"):
+        return cls(await YTDLSource.extract_info(url, loop=loop, stream=True, guild_id=guild_id, kind=kind))
+
+    @property
+    def data(self):
+        return {field: getattr(self, field) for field in METADATA_FIELDS}
+
+    @property
+    def humanized_data(self):
+        return YTDLSource.humanize(self.data)
+
+    def create_discord_embed(self, **kwargs):
+        return YTDLSource.create_discord_embed(self, **kwargs) #type:ignore
+
+    @property
+    def is_resolved(self):
+        "Entries coming from a playlist only carry a stream url once resolved"
+        return self.url is not None
+
+    @property
+    def local_path(self):
+        "File of this track in the audio cache, if any"
+        return audio_cache.lookup(normalize_key(self.webpage_url)) if self.webpage_url else None
+
+    @property
+    def location(self):
+        return self.local_path or self.url
+
+    def _track_expiry(self):
+        self.expires_at = stream_url_expiry(self.url, metadata_cache.stream_ttl) if self.is_resolved else None
+
+    def url_is_fresh(self, within: float = 0):
+        "Whether the entry can be played from its stream url (or the audio cache) for another `within` seconds"
+        if self.local_path is not None:
+            return True
+        return self.expires_at is not None and self.expires_at > time.time()+within
+
+    async def refresh(self, *, loop=None, guild_id=None, kind="interactive", fresh_for: float = 0):
+        "Resolves the stream url again, filling in metadata missing from flat playlist entries"
+        data = await YTDLSource.extract_info(self.webpage_url or self.url, loop=loop, stream=True, guild_id=guild_id, kind=kind, fresh_for=fresh_for)
+        for field in METADATA_FIELDS:
+            if data.get(field) is not None:
+                setattr(self, field, data[field])
+        self._track_expiry()
+
+    def _create_audio(self, location: str, volume: float, mode: str):
+        if mode == "opus":
+            return OpusSource.create_audio(location, self.data, volume)
+        if mode == "worker":
+            return WorkerSource.create_audio(location, volume)
+        with metrics.ffmpeg_spawn_seconds.time():
+            return discord.FFmpegPCMAudio(location, before_options=before_options_for(location), options=ffmpeg_options["options"])
+
+    @staticmethod
+    def _prepare_key(volume: float, mode: str):
+        # Opus audio has the volume baked in by FFmpeg
+        return (mode, volume if mode == "opus" else None)
+
+    def prepare(self, buffer_frames: int, *, volume: float = 0.5, mode: str = "pcm"):
+        "Starts the decoder and buffers its first frames, blocking."
+        if self.prepared is not None:
+            return
+        audio = self._create_audio(self.location, volume, mode)
+        # Worker audio buffers packets by itself
+        if not isinstance(audio, WorkerAudio):
+            audio = BufferedAudio(audio)
+        audio.fill(buffer_frames)
+        self.prepared, self.prepared_for = audio, self._prepare_key(volume, mode)
+
+    def create_source(self, volume: float = 0.5, mode: str = "pcm"):
+        audio, self.prepared = self.prepared, None
+        if audio is not None and self.prepared_for != self._prepare_key(volume, mode):
+            audio.cleanup()
+            audio = None
+        self.release()
+        location = self.location
+        if audio is None:
+            audio = self._create_audio(location, volume, mode)
+        if mode == "opus":
+            self.source = OpusSource(audio, data=self.data, volume=volume, location=location)
+        elif mode == "worker":
+            self.source = WorkerSource(audio, data=self.data, volume=volume)
+        else:
+            self.source = YTDLSource(audio, data=self.data, volume=volume)
+        return self.source
+
+    def release(self):
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+        if self.prepared is not None:
+            self.prepared.cleanup()
+            self.prepared = None
+
+
+async def iter_playlist(url, *, first_page_size: int = 10, page_size: int = 50, max_entries: int = 200, guild_id=None):
+    """Yields unresolved QueueEntry objects of a playlist page by page.
 
-        filename = data["url"] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+    The first page is kept small so playback can start early. Stream urls are
+    only resolved once an entry is about to play. A url which is not a
+    playlist yields its single, already resolved, entry."""
+    start = 1
+    size = first_page_size
+    while start <= max_entries:
+        end = min(start+size-1, max_entries)
+        # Playback waits for the first page only, the rest is bulk work
+        async with admission.admit(guild_id, "interactive" if start == 1 else "bulk"):
+            page = await engine.extract_playlist_page(url, start, end, fields=METADATA_FIELDS)
+        for data in page["entries"]:
+            yield QueueEntry(data)
+        if not page["playlist"] or page["count"] < end-start+1:
+            return
+        start = end+1
+        size = page_size
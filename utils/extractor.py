@@ -0,0 +1,179 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Optional
+
+from utils import metrics
+
+
+# YoutubeDL instances owned by the current worker process
+_worker_ytdl = None
+_worker_flat_ytdl = None
+
+
+def _init_worker(options: dict):
+    global _worker_ytdl, _worker_flat_ytdl
+    import yt_dlp
+    # Suppress noise about console usage from errors
+    yt_dlp.utils.bug_reports_message = lambda *args, **kwargs: ""
+    _worker_ytdl = yt_dlp.YoutubeDL(options)
+    _worker_flat_ytdl = yt_dlp.YoutubeDL(dict(options, noplaylist=False, extract_flat="in_playlist"))
+
+
+def _ready():
+    return True
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def _extract(url: str, download: bool, fields: Optional[tuple], params: Optional[dict] = None):
+    # Per call params (like the download directory) only apply to this call
+    previous = {key: _worker_ytdl.params[key] for key in params or () if key in _worker_ytdl.params}
+    _worker_ytdl.params.update(params or {})
+    try:
+        data = _worker_ytdl.extract_info(url, download=download)
+        if "entries" in data:
+            # Takes the first item from a playlist
+            data = data["entries"][0]
+        filename = _worker_ytdl.prepare_filename(data) if download else None
+    except Exception as exc:
+        # yt-dlp errors carry unpicklable state, only their message crosses the process boundary
+        raise ExtractionError(str(exc)) from None
+    finally:
+        for key in params or ():
+            _worker_ytdl.params.pop(key, None)
+        _worker_ytdl.params.update(previous)
+    if fields is not None:
+        # Only ship back what the caller needs, the full info dict is large
+        data = {field: data.get(field) for field in fields}
+    if download:
+        data["filename"] = filename
+    return data
+
+
+def _extract_playlist_page(url: str, start: int, end: int, fields: tuple):
+    # Items are 1 based and inclusive, the worker serves one call at a time so the params can be swapped
+    _worker_flat_ytdl.params["playlist_items"] = f"{start}:{end}"
+    try:
+        data = _worker_flat_ytdl.extract_info(url, download=False)
+    except Exception as exc:
+        raise ExtractionError(str(exc)) from None
+    if "entries" not in data:
+        return {"playlist": False, "entries": [{field: data.get(field) for field in fields}]}
+    entries = []
+    raw_entries = list(data["entries"])
+    for entry in raw_entries:
+        if not entry:
+            continue
+        thumbnails = entry.get("thumbnails") or [{}]
+        # Flat entries name some fields differently, and their url is the page rather than a stream
+        item = {"title": entry.get("title"),
+                "webpage_url": entry.get("webpage_url") or entry.get("url"),
+                "uploader": entry.get("uploader") or entry.get("channel"),
+                "duration": entry.get("duration"),
+                "view_count": entry.get("view_count"),
+                "thumbnail": thumbnails[-1].get("url")}
+        entries.append({field: item.get(field) for field in fields})
+    # Unavailable items come back empty, count tells whether the page was full
+    return {"playlist": True, "title": data.get("title"), "count": len(raw_entries), "entries": entries}
+
+
+class ExtractionEngine:
+    """Runs yt-dlp extractions on a pool of worker processes.
+
+    Each worker holds its own YoutubeDL instance. The number of extractions
+    in flight is bounded, every call has a timeout, and the pool is replaced
+    after `max_tasks_per_pool` calls or whenever a call times out, so leaked
+    extractor state and hung workers do not live forever.
+    """
+    def __init__(self, options: dict, workers: int = 2, max_in_flight: Optional[int] = None, timeout: float = 30, max_tasks_per_pool: int = 500):
+        self.options = options
+        self.workers = workers
+        self.max_in_flight = max_in_flight or workers*2
+        self.timeout = timeout
+        self.max_tasks_per_pool = max_tasks_per_pool
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_tasks = 0
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.timeouts = 0
+
+    def configure(self, *, workers: Optional[int] = None, max_in_flight: Optional[int] = None, timeout: Optional[float] = None):
+        if workers is not None:
+            self.workers = workers
+            self.max_in_flight = max_in_flight or workers*2
+        elif max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+        if timeout is not None:
+            self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._retire_pool()
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(self.options,))
+            self._pool_tasks = 0
+        return self._pool
+
+    async def warm_up(self):
+        "Starts the workers ahead of the first extraction, which otherwise waits for them to load yt-dlp"
+        loop = asyncio.get_running_loop()
+        pool = self.start()
+        await asyncio.gather(*(loop.run_in_executor(pool, _ready) for _ in range(self.workers)))
+
+    def shutdown(self):
+        self._retire_pool()
+
+    def _retire_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            self._stop_pool(pool)
+
+    @staticmethod
+    def _stop_pool(pool: ProcessPoolExecutor, terminate: bool = False):
+        # Submitted calls still complete, unless the workers are terminated in
+        # which case they fail with BrokenProcessPool and get retried
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False)
+        if terminate:
+            for process in processes:
+                process.terminate()
+
+    async def extract(self, url: str, *, download: bool = False, fields: Optional[Iterable[str]] = None, params: Optional[dict] = None):
+        return await self._run(_extract, url, download, tuple(fields) if fields is not None else None, params)
+
+    async def extract_playlist_page(self, url: str, start: int, end: int, *, fields: Iterable[str]):
+        """Flat extracts the items start to end (1 based, inclusive) of a playlist.
+
+        Returns a dict with `playlist` set to False and the fully extracted item
+        in `entries` when url is not a playlist."""
+        return await self._run(_extract_playlist_page, url, start, end, tuple(fields))
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            for attempt in range(2):
+                pool = self.start()
+                started = loop.time()
+                future = loop.run_in_executor(pool, func, *args)
+                self._pool_tasks += 1
+                if self._pool_tasks >= self.max_tasks_per_pool:
+                    self._retire_pool()
+                try:
+                    result = await asyncio.wait_for(future, self.timeout)
+                    metrics.extraction_seconds.labels(func.__name__.lstrip("_")).observe(loop.time()-started)
+                    return result
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    if self._pool is pool:
+                        self._pool = None
+                    self._stop_pool(pool, terminate=True)
+                    raise
+                except BrokenProcessPool:
+                    # The pool died under us (recycled after a timeout or crashed), retry once on a fresh one
+                    if self._pool is pool:
+                        self._retire_pool()
+                    if attempt:
+                        raise
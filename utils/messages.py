@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from utils import metrics
+from utils.printer import print_error
+from utils.scheduler import DeadlineScheduler
+
+
+class _Update:
+    __slots__ = ("func", "kwargs", "lines", "render", "not_before", "future")
+
+    def __init__(self, func: Callable, kwargs: dict, future: asyncio.Future, *, not_before: float = 0.0, render: Optional[Callable] = None):
+        self.func = func
+        self.kwargs = kwargs
+        self.lines: list[str] = []
+        self.render = render
+        self.not_before = not_before
+        self.future = future
+
+
+class _Channel:
+    __slots__ = ("tokens", "updated_at", "pending")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated_at = now
+        self.pending: OrderedDict[Hashable, _Update] = OrderedDict()
+
+
+class MessageScheduler:
+    """Sends and edits messages through a queue per channel.
+
+    Each channel has a token bucket of `rate` messages per `per` seconds,
+    matching discord's limit, updates beyond it wait for the deadline
+    scheduler instead of running into 429s. Updates queued under the same
+    key are merged while waiting, later keyword arguments winning, so a
+    message edited ten times in a burst is edited once. Lines given to
+    `send_batched` are collected for `batch_delay` seconds into a single
+    summary message.
+    """
+    def __init__(self, scheduler: DeadlineScheduler, rate: int = 5, per: float = 5.0, batch_delay: float = 1.0):
+        self.scheduler = scheduler
+        self.rate = rate
+        self.per = per
+        self.batch_delay = batch_delay
+        self._channels: dict[int, _Channel] = {}
+        self._keys = itertools.count()
+        self._tasks: set[asyncio.Task] = set()
+
+    def update(self, channel_id: int, func: Callable[..., Any], *, key: Optional[Hashable] = None, **kwargs):
+        """Queues awaiting func(**kwargs) in the channel, returns a future of its result.
+
+        While an update with the same key waits, kwargs are merged into it and
+        its future is returned instead."""
+        channel = self._channel(channel_id)
+        pending = channel.pending.get(key) if key is not None else None
+        if pending is not None:
+            metrics.message_updates.inc("merged")
+            pending.func = func
+            pending.kwargs.update(kwargs)
+            return pending.future
+        update = _Update(func, kwargs, asyncio.get_running_loop().create_future())
+        channel.pending[key if key is not None else next(self._keys)] = update
+        self._pump(channel_id)
+        return update.future
+
+    def send(self, destination, *, key: Optional[Hashable] = None, **kwargs):
+        "Sends a message to destination (a channel or context), returns a future of the message"
+        return self.update(self._channel_id(destination), destination.send, key=key, **kwargs)
+
+    def edit(self, message, **kwargs):
+        "Edits message, edits still waiting for the same message are merged"
+        return self.update(message.channel.id, message.edit, key=("edit", message.id), **kwargs)
+
+    def send_batched(self, destination, key: Hashable, line: str, render: Callable[[list[str]], dict]):
+        """Adds line to the summary message under key, sent `batch_delay` seconds after its first line.
+
+        render turns the collected lines into the keyword arguments of send."""
+        channel_id = self._channel_id(destination)
+        channel = self._channel(channel_id)
+        pending = channel.pending.get(key)
+        if pending is None or pending.render is None:
+            loop = asyncio.get_running_loop()
+            pending = _Update(destination.send, {}, loop.create_future(), not_before=loop.time()+self.batch_delay, render=render)
+            channel.pending[key] = pending
+            self._pump(channel_id)
+        else:
+            metrics.message_updates.inc("merged")
+        pending.lines.append(line)
+        return pending.future
+
+    @staticmethod
+    def _channel_id(destination):
+        # Contexts carry their channel, channels are their own
+        return destination.channel.id if hasattr(destination, "channel") else destination.id
+
+    def _channel(self, channel_id: int):
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._channels[channel_id] = _Channel(self.rate, asyncio.get_running_loop().time())
+        return channel
+
+    def _pump(self, channel_id: int):
+        "Runs the updates of a channel which are due and have a token, then schedules itself for the rest"
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return
+        now = asyncio.get_running_loop().time()
+        channel.tokens = min(self.rate, channel.tokens+(now-channel.updated_at)*self.rate/self.per)
+        channel.updated_at = now
+        for key, update in list(channel.pending.items()):
+            if channel.tokens < 1:
+                break
+            if update.not_before > now:
+                continue
+            channel.tokens -= 1
+            del channel.pending[key]
+            task = asyncio.get_running_loop().create_task(self._run(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        token_wait = max((1-channel.tokens)*self.per/self.rate, 0.0)
+        if not channel.pending:
+            if channel.tokens >= self.rate:
+                # Idle channels are forgotten once their bucket is full again
+                del self._channels[channel_id]
+            else:
+                self.scheduler.schedule(("messages", channel_id), (self.rate-channel.tokens)*self.per/self.rate, lambda: self._pump(channel_id))
+            return
+        due_wait = max(min(update.not_before for update in channel.pending.values())-now, 0.0)
+        self.scheduler.schedule(("messages", channel_id), max(token_wait, due_wait), lambda: self._pump(channel_id))
+
+    async def _run(self, update: _Update):
+        kwargs = dict(update.kwargs, **update.render(update.lines)) if update.render is not None else update.kwargs
+        try:
+            result = await update.func(**kwargs)
+        except Exception as exc:
+            print_error("Message Update Error", exc)
+            metrics.message_updates.inc("failed")
+            if not update.future.done():
+                update.future.set_exception(exc)
+                # Fire and forget callers never look at the future
+                update.future.exception()
+            return
+        metrics.message_updates.inc("sent")
+        if not update.future.done():
+            update.future.set_result(result)
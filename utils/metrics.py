@@ -0,0 +1,194 @@
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+
+# Seconds, growing by half from 1ms to about 60s, which keeps quantile estimates within ~25%
+DEFAULT_BUCKETS = tuple(round(0.001*1.5**exponent, 6) for exponent in range(28))
+
+
+class _HistogramSeries:
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        # One slot per bound plus the overflow (+Inf) slot
+        self.counts = [0]*(len(bounds)+1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter()-started)
+
+    def quantile(self, q: float):
+        "Estimates a quantile by interpolating inside its bucket"
+        if not self.count:
+            return None
+        rank = q*self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen+count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index-1] if index else 0.0
+                return lower + (self.bounds[index]-lower)*(rank-seen)/count
+            seen += count
+        return self.bounds[-1]
+
+
+class Histogram:
+    """Fixed bucket histogram, optionally split into series by label values.
+
+    Observing is a bisect and three additions, cheap enough for hot paths.
+    Only the event loop thread and the player threads write to it, a lost
+    increment from a race is acceptable for these numbers.
+    """
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, _HistogramSeries] = {}
+        if not self.label_names:
+            self._series[()] = _HistogramSeries(self.buckets)
+
+    def labels(self, *values: str):
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = _HistogramSeries(self.buckets)
+        return series
+
+    def observe(self, value: float):
+        self._series[()].observe(value)
+
+    def time(self):
+        return self._series[()].time()
+
+    def series(self):
+        return list(self._series.items())
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *values: str, amount: float = 1):
+        self._values[values] = self._values.get(values, 0)+amount
+
+    def value(self, *values: str):
+        return self._values.get(values, 0)
+
+    def series(self):
+        return list(self._values.items())
+
+
+class Registry:
+    def __init__(self, prefix: str = "lightbulb_"):
+        self.prefix = prefix
+        self.metrics: dict[str, Histogram | Counter] = {}
+
+    def histogram(self, name: str, description: str, label_names: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, description, label_names, buckets))
+
+    def counter(self, name: str, description: str, label_names: Iterable[str] = ()):
+        return self.metrics.setdefault(name, Counter(name, description, label_names))
+
+    @staticmethod
+    def _format_labels(names: tuple, values: tuple, extra: str = ""):
+        pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{"+",".join(pairs)+"}" if pairs else ""
+
+    def render_prometheus(self):
+        "Renders every metric in the Prometheus text exposition format"
+        lines = []
+        for metric in self.metrics.values():
+            name = self.prefix+metric.name
+            lines.append(f"# HELP {name} {metric.description}")
+            if isinstance(metric, Counter):
+                lines.append(f"# TYPE {name} counter")
+                for values, value in metric.series():
+                    lines.append(f"{name}{self._format_labels(metric.label_names, values)} {value}")
+                continue
+            lines.append(f"# TYPE {name} histogram")
+            for values, series in metric.series():
+                cumulative = 0
+                for bound, count in zip(metric.buckets+(float("inf"),), series.counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                    lines.append(f"{name}_bucket{self._format_labels(metric.label_names, values, le)} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(metric.label_names, values)} {series.sum}")
+                lines.append(f"{name}_count{self._format_labels(metric.label_names, values)} {series.count}")
+        return "\n".join(lines)+"\n"
+
+
+registry = Registry()
+
+extraction_seconds = registry.histogram("extraction_seconds", "Time spent in yt-dlp extractions.", ("kind",))
+extractions_coalesced = registry.counter("extractions_coalesced_total", "Extractions answered by joining an identical one in flight.")
+metadata_cache_lookups = registry.counter("metadata_cache_lookups_total", "Metadata cache lookups by result.", ("result",))
+source_create_seconds = registry.histogram("source_create_seconds", "Time to create a playable source from an url, extraction included.", ("mode",))
+ffmpeg_spawn_seconds = registry.histogram("ffmpeg_spawn_seconds", "Time to spawn an FFmpeg process.")
+queue_transition_seconds = registry.histogram("queue_transition_seconds", "Silence between the end of a track and the start of the next one.")
+admission_rejections = registry.counter("admission_rejections_total", "Extractions turned away as overloaded, by whether the guild's or the overall queue was full.", ("queue",))
+autocomplete_requests = registry.counter("autocomplete_requests_total", "Autocomplete requests by how they were answered.", ("result",))
+command_seconds = registry.histogram("command_seconds", "Command latency from invocation to completion.", ("command",))
+command_errors = registry.counter("command_errors_total", "Commands which raised an error.", ("command",))
+# Fed by the heartbeat of utils.watchdog.LoopWatchdog
+loop_lag_seconds = registry.histogram("loop_lag_seconds", "How late the event loop ran a periodic callback.",
+                                      buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+message_updates = registry.counter("message_updates_total", "Message sends and edits by what became of them.", ("result",))
+loop_block_seconds = registry.histogram("loop_block_seconds", "Duration of the event loop blocks caught by the watchdog.")
+
+
+class MetricsServer:
+    """Minimal HTTP server answering every GET with the Prometheus text of a registry.
+
+    Binds to localhost only, scraping from elsewhere needs a proxy in front.
+    """
+    def __init__(self, registry: Registry, port: int, host: str = "127.0.0.1"):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            if request.startswith(b"GET "):
+                body = self.registry.render_prometheus().encode()
+                head = f"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            else:
+                body = b""
+                head = "HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+            writer.write(head.encode()+body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
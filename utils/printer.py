@@ -1,5 +1,10 @@
+import atexit
+import os
 import sys
-from typing import Dict, Union, Any, TextIO, Iterable
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Union, Any, TextIO, Iterable
 
 dict_updater = lambda base,updater:(lambda dbase,dupdt:[dbase.update(dupdt), dbase][-1])(base.copy(), updater)
 
@@ -32,11 +37,151 @@ class MultiWritePipe:
             pipe.seek(__cookie, __whence)
 
 
+class RotatingFile:
+    """Append only log file, rotated to `path.1` ... `path.<backup_count>` once it grows past max_bytes."""
+    def __init__(self, path: str, max_bytes: int = 10*1024*1024, backup_count: int = 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = open(path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+    
+    @property
+    def closed(self):
+        return self._file.closed
+    
+    def write(self, __s: str):
+        # The limit is in bytes, titles outside of ASCII take several per character
+        size = len(__s.encode('utf-8'))
+        if self.max_bytes and self._size and self._size+size > self.max_bytes:
+            self.rotate()
+        self._file.write(__s)
+        self._size += size
+    
+    def flush(self):
+        self._file.flush()
+    
+    def close(self):
+        self._file.close()
+    
+    def rotate(self):
+        self._file.close()
+        for index in range(self.backup_count-1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index+1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._size = 0
+
+
+class AsyncLogPipe:
+    """Pipe which hands writes to a background thread instead of doing them on the caller.
+    
+    `write` only appends to an in-memory queue. The writer thread drains it in
+    batches, does one write per target per batch and flushes the targets every
+    `flush_interval` seconds instead of per line.
+    
+    Writes never block. Once `max_pending` items are queued new ones are
+    dropped, and a line telling how many were lost is written when the writer
+    catches up. Write errors of a target are reported on stderr and the line
+    is dropped for that target only.
+    """
+    def __init__(self, *target_pipes: TextIO, max_pending: int = 10000, flush_interval: float = 1.0):
+        self.target_pipes = target_pipes
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._pending = deque()
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._flush_requested = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        # Queued lines still make it out when the interpreter exits without close
+        atexit.register(self.close)
+    
+    @property
+    def closed(self):
+        return self._closing
+    
+    def write(self, __s: Union[str, Callable[[], str]]):
+        "Queues a string, or a callable returning one which is then called on the writer thread"
+        if self._closing:
+            return
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(__s)
+        self._wakeup.set()
+    
+    def writelines(self, __lines: Iterable[str]):
+        for line in __lines:
+            self.write(line)
+    
+    def flush(self):
+        "Asks for a flush once the queued writes are done, without waiting for it"
+        self._flush_requested = True
+        self._wakeup.set()
+    
+    def close(self):
+        "Writes out what is queued, then closes the targets which are not standard streams"
+        if self._closing:
+            return
+        self._closing = True
+        self._wakeup.set()
+        self._thread.join()
+        for pipe in self.target_pipes:
+            if pipe not in (sys.stdout, sys.stderr):
+                pipe.close()
+        atexit.unregister(self.close)
+    
+    def _run(self):
+        last_flush = time.monotonic()
+        reported_drops = 0
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            closing = self._closing
+            batch = []
+            while self._pending:
+                item = self._pending.popleft()
+                try:
+                    batch.append(item() if callable(item) else item)
+                except Exception as exc:
+                    batch.append(f"Log formatting error: {exc!r}\n")
+            if self.dropped != reported_drops:
+                batch.append(f"[log] {self.dropped-reported_drops} log entries dropped, writer could not keep up\n")
+                reported_drops = self.dropped
+            if batch:
+                self._write_all("".join(batch))
+            if closing or self._flush_requested or time.monotonic()-last_flush >= self.flush_interval:
+                self._flush_requested = False
+                self._flush_all()
+                last_flush = time.monotonic()
+            if closing and not self._pending:
+                break
+    
+    def _write_all(self, text: str):
+        for pipe in self.target_pipes:
+            try:
+                pipe.write(text)
+            except (OSError, ValueError) as exc:
+                sys.stderr.write(f"Log write error on {pipe!r}: {exc}\n")
+    
+    def _flush_all(self):
+        for pipe in self.target_pipes:
+            try:
+                pipe.flush()
+            except (OSError, ValueError):
+                pass
+
+
 class PrettyPrinter:
     _PRINTERS = []
     _DEFAULT_PRINTER = None
     
-    def __new__(cls):
+    def __new__(cls, *args, **kw):
         instance = super().__new__(cls)
         cls._PRINTERS.append(instance)
         return instance
@@ -67,6 +212,11 @@ class PrettyPrinter:
     
     def print_info(self, header_text: str, info_entries: Dict[str,Any], **kw):
         kwargs = dict_updater(self.defaults, dict_updater({'header_text':header_text, 'info_entries':info_entries}, kw))
+        if isinstance(self.pipe, AsyncLogPipe):
+            # Formatting happens on the writer thread, entries are copied as they may change meanwhile
+            kwargs['info_entries'] = dict(info_entries)
+            self.pipe.write(lambda: "\n".join(self.make_info(**kwargs))+"\n")
+            return
         lines = self.make_info(**kwargs)
         self.pipe.write("\n".join(lines)+"\n")
         self.pipe.flush()
@@ -77,3 +227,12 @@ class PrettyPrinter:
     def print_debug(self, header_text: str, info_entries: Dict[str,Any], *args, **kw):
         if self.debug:
             self.print_info(header_text, info_entries, *args, **kw)
+    
+    def make_default(self):
+        "Makes this the printer of print_error"
+        type(self)._DEFAULT_PRINTER = self
+
+
+def print_error(header_text: str, error: Any, **info_entries: Any):
+    "Reports an error through the default printer, code without a bot at hand uses it in place of print"
+    PrettyPrinter._get_default().print_info(header_text, dict(info_entries, error=error))
@@ -0,0 +1,88 @@
+import asyncio
+import heapq
+import itertools
+from typing import Any, Callable, Hashable, Optional
+
+from utils.printer import print_error
+
+
+class DeadlineScheduler:
+    """Runs callbacks at their deadlines from a single task.
+
+    Deadlines are kept in a heap and identified by a key, scheduling a key
+    again replaces its previous deadline. Replaced heap items are skipped
+    when they come up. The task sleeps until the earliest deadline, so
+    nothing wakes up while no deadline is due.
+    """
+    def __init__(self):
+        self._heap: list[tuple[float, int, Hashable]] = []
+        self._pending: dict[Hashable, tuple[float, int, Callable[[], Any]]] = {}
+        self._counter = itertools.count()
+        self._changed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._callbacks: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[], Any]):
+        "Calls callback after delay seconds, callback may return an awaitable"
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._changed = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        item = (loop.time()+delay, next(self._counter), key)
+        self._pending[key] = (item[0], item[1], callback)
+        heapq.heappush(self._heap, item)
+        if len(self._heap) > 2*len(self._pending)+64:
+            # Drops replaced items once they make up most of the heap
+            self._heap = [(deadline, counter, key) for key, (deadline, counter, _) in self._pending.items()]
+            heapq.heapify(self._heap)
+        # Only an earlier deadline changes how long the task has to sleep
+        if self._heap[0][1] == item[1]:
+            self._changed.set()
+
+    def cancel(self, key: Hashable):
+        self._pending.pop(key, None)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._heap.clear()
+        self._pending.clear()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._changed.clear()
+            if not self._heap:
+                await self._changed.wait()
+                continue
+            delay = self._heap[0][0]-loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            deadline, counter, key = heapq.heappop(self._heap)
+            pending = self._pending.get(key)
+            if pending is None or pending[1] != counter:
+                continue
+            del self._pending[key]
+            try:
+                result = pending[2]()
+                if asyncio.iscoroutine(result):
+                    task = loop.create_task(self._guard(key, result))
+                    self._callbacks.add(task)
+                    task.add_done_callback(self._callbacks.discard)
+            except Exception as exc:
+                print_error("Scheduled Callback Error", exc, key=key)
+
+    @staticmethod
+    async def _guard(key: Hashable, coro):
+        try:
+            await coro
+        except Exception as exc:
+            print_error("Scheduled Callback Error", exc, key=key)
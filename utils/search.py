@@ -0,0 +1,143 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import discord
+
+from utils import metrics
+from utils.admission import AdmissionController, Overloaded
+from utils.downloader import admission, engine
+from utils.printer import print_error
+from utils.extractor import ExtractionEngine
+
+
+def _normalize(query: str):
+    return ' '.join(query.casefold().split())
+
+
+class SearchCompleter:
+    """Autocomplete choices from flat searches, answering within the interaction deadline.
+
+    Discord sends an autocomplete request per keystroke. A search only
+    starts once a user stopped typing for `debounce` seconds, and a newer
+    request of the same user cancels the older one's search. Results are
+    kept in an LRU by query. While a search is still running, or when it
+    misses the deadline, the results of the longest cached prefix of the
+    query stand in, filtered down to titles matching every typed word.
+    Searches wait for admission as interactive work of the user's guild.
+    """
+    def __init__(self, engine: ExtractionEngine, admission: AdmissionController, *, limit: int = 10, min_length: int = 3, debounce: float = 0.3, deadline: float = 2.5,
+                 max_entries: int = 512, ttl: float = 10*60):
+        self.engine = engine
+        self.admission = admission
+        self.limit = limit
+        self.min_length = min_length
+        self.debounce = debounce
+        self.deadline = deadline
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._results: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        # Search in flight per user, along with its query
+        self._pending: dict[int, tuple[str, asyncio.Task]] = {}
+
+    def cached(self, query: str):
+        record = self._results.get(query)
+        if record is None or record[0]+self.ttl < time.monotonic():
+            return None
+        self._results.move_to_end(query)
+        return record[1]
+
+    def from_prefix(self, query: str):
+        "Filters the results of the longest cached prefix of query"
+        words = query.split()
+        for length in range(len(query)-1, self.min_length-1, -1):
+            results = self.cached(query[:length])
+            if results is not None:
+                return [result for result in results if all(word in (result["title"] or "").casefold() for word in words)]
+        return []
+
+    def _remember(self, query: str, results: list[dict]):
+        self._results[query] = (time.monotonic(), results)
+        self._results.move_to_end(query)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    async def _search(self, query: str, guild_id: Optional[int]):
+        await asyncio.sleep(self.debounce)
+        async with self.admission.admit(guild_id, "interactive"):
+            fetch = asyncio.get_running_loop().create_task(self._fetch(query))
+            try:
+                return await asyncio.shield(fetch)
+            except asyncio.CancelledError:
+                # A pool call cannot be stopped, so the slot stays taken until it is done, and its results still fill the cache
+                await asyncio.wait([fetch])
+                if not fetch.cancelled():
+                    fetch.exception()
+                raise
+
+    async def _fetch(self, query: str):
+        page = await self.engine.extract_playlist_page(f"ytsearch{self.limit}:{query}", 1, self.limit, fields=("title", "webpage_url", "uploader", "duration"))
+        results = [entry for entry in page["entries"] if entry.get("webpage_url")]
+        self._remember(query, results)
+        return results
+
+    async def search(self, user_id: int, query: str, guild_id: Optional[int] = None):
+        "Returns search results for query, falling back to prefix results instead of missing the deadline"
+        query = _normalize(query)
+        if len(query) < self.min_length:
+            return []
+        results = self.cached(query)
+        if results is not None:
+            metrics.autocomplete_requests.inc("hit")
+            return results
+        pending_query, task = self._pending.get(user_id, (None, None))
+        if pending_query != query:
+            if task is not None:
+                task.cancel()
+            task = asyncio.get_running_loop().create_task(self._search(query, guild_id))
+            self._pending[user_id] = (query, task)
+            task.add_done_callback(lambda task: self._forget(user_id, task))
+        try:
+            # Shielded, a search missing the deadline still fills the cache for the next keystroke
+            results = await asyncio.wait_for(asyncio.shield(task), self.deadline)
+            metrics.autocomplete_requests.inc("search")
+            return results
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            # Superseded by a newer request, which is the one discord still waits for
+            metrics.autocomplete_requests.inc("superseded")
+        except asyncio.TimeoutError:
+            metrics.autocomplete_requests.inc("timeout")
+        except Overloaded:
+            metrics.autocomplete_requests.inc("overloaded")
+        except Exception as exc:
+            print_error("Autocomplete Search Error", exc, query=query)
+        return self.from_prefix(query)
+
+    def _forget(self, user_id: int, task: asyncio.Task):
+        if self._pending.get(user_id, (None, None))[1] is task:
+            del self._pending[user_id]
+        # Failures of searches nobody waits for anymore are not worth a warning
+        if not task.cancelled():
+            task.exception()
+
+    async def complete(self, ctx: discord.AutocompleteContext):
+        "Autocomplete callback for url options, choices play the picked result's url"
+        results = await self.search(ctx.interaction.user.id, ctx.value or "", ctx.interaction.guild_id)
+        return [discord.OptionChoice(name=self.describe(result)[:100], value=result["webpage_url"])
+                for result in results if len(result["webpage_url"]) <= 100]
+
+    @staticmethod
+    def describe(result: dict):
+        description = result["title"] or result["webpage_url"]
+        if result.get("uploader"):
+            description += f" - {result['uploader']}"
+        if result.get("duration"):
+            minutes, seconds = divmod(int(result["duration"]), 60)
+            description += f" ({minutes}:{seconds:02})"
+        return description
+
+
+search_completer = SearchCompleter(engine, admission)
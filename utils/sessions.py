@@ -0,0 +1,57 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class SessionStore:
+    """SQLite file of queue snapshots, one row per guild.
+
+    Rows older than `max_age` are dropped when the store is opened, a
+    session nobody came back to for that long is not worth restoring.
+    Does nothing until `open` is called.
+    """
+    def __init__(self, max_age: float = 24*60*60):
+        self.max_age = max_age
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._db is not None
+
+    def open(self, path: str):
+        with self._lock:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions (guild_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time()-self.max_age,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def load_all(self):
+        "Returns the stored snapshots by guild id"
+        if not self.enabled:
+            return {}
+        with self._lock:
+            rows = self._db.execute("SELECT guild_id, data FROM sessions").fetchall()
+        return {guild_id: json.loads(data) for guild_id, data in rows}
+
+    def write(self, saved: dict[int, dict], deleted: list[int]):
+        "Stores the snapshots in saved and drops the guilds in deleted, in one transaction"
+        if not self.enabled:
+            return
+        now = time.time()
+        rows = [(guild_id, json.dumps(snapshot), now) for guild_id, snapshot in saved.items()]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", rows)
+            self._db.executemany("DELETE FROM sessions WHERE guild_id = ?", [(guild_id,) for guild_id in deleted])
+            self._db.commit()
+
+
+session_store = SessionStore()
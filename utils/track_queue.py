@@ -0,0 +1,130 @@
+import random
+from collections import deque
+from itertools import islice
+from typing import Iterable, Optional
+
+from utils.downloader import QueueEntry
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TrackQueue:
+    """The entry being played, between a bounded window of played entries and the upcoming ones.
+
+    Upcoming entries are addressed by 1 based positions, 1 being up next.
+    Appending and advancing are O(1). Inserting, removing and
+    moving are O(position) walks over a deque, shuffling is O(n). Played
+    entries are released and only the last `max_history` are kept, and at
+    most `max_upcoming` entries may wait, so a session never outgrows
+    them however long it runs.
+    """
+    def __init__(self, max_history: int = 50, max_upcoming: int = 5000):
+        self.max_upcoming = max_upcoming
+        self.current: Optional[QueueEntry] = None
+        self.history: deque[QueueEntry] = deque(maxlen=max_history)
+        self.upcoming: deque[QueueEntry] = deque()
+        # Bumped by every change, tells snapshots whether there is anything new to save
+        self.version = 0
+
+    def __len__(self):
+        "Entries still to be played, the current one included"
+        return len(self.upcoming) + (self.current is not None)
+
+    def __iter__(self):
+        if self.current is not None:
+            yield self.current
+        yield from self.upcoming
+
+    def __getitem__(self, index: int):
+        "Indexes the current entry (0, when there is one) followed by the upcoming ones"
+        if self.current is not None:
+            if index == 0:
+                return self.current
+            index -= 1
+        return self.upcoming[index]
+
+    def window(self, start: int, stop: int):
+        "Entries from start to stop, indexed like __getitem__"
+        return list(islice(self, start, stop))
+
+    @property
+    def room(self):
+        "How many more entries fit into the queue"
+        return self.max_upcoming-len(self.upcoming)
+
+    def ensure_room(self, count: int = 1):
+        if count > self.room:
+            raise QueueFull(f"The queue is limited to {self.max_upcoming} entries.")
+
+    def append(self, entry: QueueEntry):
+        self.ensure_room()
+        self.version += 1
+        self.upcoming.append(entry)
+
+    def extend(self, entries: Iterable[QueueEntry]):
+        for entry in entries:
+            self.append(entry)
+
+    def insert(self, position: int, entry: QueueEntry):
+        self.ensure_room()
+        self.version += 1
+        self.upcoming.insert(self._clamp(position)-1, entry)
+
+    def advance(self):
+        "Moves the current entry into the history and the next one up, returns the new current entry"
+        self.version += 1
+        if self.current is not None:
+            self.current.release()
+            self.history.append(self.current)
+        self.current = self.upcoming.popleft() if self.upcoming else None
+        return self.current
+
+    def previous(self):
+        "Puts the current entry back up next and makes the last played entry current again"
+        if not self.history:
+            return None
+        self.version += 1
+        if self.current is not None:
+            self.current.release()
+            self.upcoming.appendleft(self.current)
+        self.current = self.history.pop()
+        return self.current
+
+    def remove(self, position: int):
+        self._check(position)
+        self.version += 1
+        entry = self.upcoming[position-1]
+        del self.upcoming[position-1]
+        return entry
+
+    def move(self, position: int, new_position: int):
+        self._check(position)
+        self.version += 1
+        entry = self.upcoming[position-1]
+        del self.upcoming[position-1]
+        self.upcoming.insert(self._clamp(new_position)-1, entry)
+        return entry
+
+    def shuffle(self):
+        self.version += 1
+        # Shuffling a deque in place indexes it n times, which is O(n^2)
+        entries = list(self.upcoming)
+        random.shuffle(entries)
+        self.upcoming = deque(entries)
+
+    def clear(self):
+        self.version += 1
+        for entry in self:
+            entry.release()
+        self.current = None
+        self.history.clear()
+        self.upcoming.clear()
+
+    def _check(self, position: int):
+        if not 1 <= position <= len(self.upcoming):
+            raise IndexError(f"There is no entry #{position} in the queue.")
+
+    def _clamp(self, position: int):
+        return min(max(position, 1), len(self.upcoming)+1)
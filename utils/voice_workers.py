@@ -0,0 +1,296 @@
+import itertools
+import json
+import multiprocessing
+import queue
+import struct
+import threading
+from collections import deque
+from multiprocessing.connection import Connection
+from typing import Optional
+
+import discord
+
+from utils.printer import print_error
+
+
+# Every message starts with its op and the id of the stream it is about
+HEADER = struct.Struct("<BI")
+# Opus packets of a PACKETS message are each prefixed by their length
+PACKET_LENGTH = struct.Struct("<H")
+VOLUME = struct.Struct("<f")
+COUNT = struct.Struct("<H")
+
+# Bot to worker
+OPEN, DEMAND, SET_VOLUME, CLOSE = range(4)
+# Worker to bot, END carries the error message, if any
+PACKETS, END = range(4, 6)
+
+# Played in place of audio a worker did not deliver in time, keeps the player's timing intact
+SILENCE = b"\xf8\xff\xfe"
+
+
+def _encode_packets(packets: list[bytes]):
+    return b"".join(PACKET_LENGTH.pack(len(packet))+packet for packet in packets)
+
+
+def _decode_packets(payload: memoryview):
+    packets = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = PACKET_LENGTH.unpack_from(payload, offset)
+        offset += PACKET_LENGTH.size
+        packets.append(bytes(payload[offset:offset+length]))
+        offset += length
+    return packets
+
+
+class _EncoderThread(threading.Thread):
+    "Decodes one stream with FFmpeg and encodes it to opus, a batch of packets per DEMAND"
+    def __init__(self, stream_id: int, options: dict, reply):
+        super().__init__(name=f"voice-stream-{stream_id}", daemon=True)
+        self.stream_id = stream_id
+        self.options = options
+        self.reply = reply
+        self.commands: queue.SimpleQueue = queue.SimpleQueue()
+
+    def run(self):
+        try:
+            audio = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(self.options["location"], before_options=self.options["before_options"],
+                                                                        options=self.options["options"]), self.options["volume"])
+            encoder = discord.opus.Encoder()
+        except Exception as exc:
+            self.reply(END, self.stream_id, str(exc).encode())
+            return
+        try:
+            while True:
+                op, payload = self.commands.get()
+                if op == CLOSE:
+                    return
+                if op == SET_VOLUME:
+                    audio.volume = VOLUME.unpack(payload)[0]
+                    continue
+                packets = []
+                ended = False
+                for _ in range(COUNT.unpack(payload)[0]):
+                    pcm = audio.read()
+                    if len(pcm) != discord.opus.Encoder.FRAME_SIZE:
+                        ended = True
+                        break
+                    packets.append(encoder.encode(pcm, encoder.SAMPLES_PER_FRAME))
+                self.reply(PACKETS, self.stream_id, _encode_packets(packets))
+                if ended:
+                    self.reply(END, self.stream_id, b"")
+                    return
+        except Exception as exc:
+            self.reply(END, self.stream_id, str(exc).encode())
+        finally:
+            audio.cleanup()
+
+
+def _serve(conn: Connection):
+    "Main of a worker process, runs an encoder thread per stream until the bot hangs up"
+    lock = threading.Lock()
+    def reply(op: int, stream_id: int, payload: bytes):
+        with lock:
+            try:
+                conn.send_bytes(HEADER.pack(op, stream_id)+payload)
+            except OSError:
+                pass
+    streams: dict[int, _EncoderThread] = {}
+    while True:
+        try:
+            message = conn.recv_bytes()
+        except (EOFError, OSError):
+            break
+        op, stream_id = HEADER.unpack_from(message)
+        payload = message[HEADER.size:]
+        if op == OPEN:
+            stream = streams[stream_id] = _EncoderThread(stream_id, json.loads(payload), reply)
+            stream.start()
+            continue
+        stream = streams.get(stream_id)
+        if stream is None:
+            continue
+        stream.commands.put((op, payload))
+        # The bot closes every stream it opened, finished ones included
+        if op == CLOSE:
+            del streams[stream_id]
+    for stream in streams.values():
+        stream.commands.put((CLOSE, b""))
+
+
+class WorkerAudio(discord.AudioSource):
+    """Opus packets of a stream decoded and encoded by a voice worker.
+
+    Packets are requested `batch` at a time whenever fewer than `low_water`
+    are buffered. When the worker falls behind, silence is played rather
+    than blocking the audio player.
+    """
+    def __init__(self, worker: "_Worker", stream_id: int, volume: float, batch: int = 50, low_water: int = 25):
+        self.worker = worker
+        self.stream_id = stream_id
+        self.batch = batch
+        self.low_water = low_water
+        self.error: Optional[str] = None
+        self._volume = volume
+        self._packets: deque[bytes] = deque()
+        self._requested = False
+        self._ended = False
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = max(value, 0.0)
+        self.worker.send(SET_VOLUME, self.stream_id, VOLUME.pack(self._volume))
+
+    def _request(self, count: int):
+        self._requested = True
+        self.worker.send(DEMAND, self.stream_id, COUNT.pack(count))
+
+    def fill(self, count: int):
+        "Waits until count packets are buffered or the stream ended, blocking"
+        with self._condition:
+            while len(self._packets) < count and not self._ended:
+                if not self._requested:
+                    self._request(min(count-len(self._packets), 0xffff))
+                if not self._condition.wait(self.worker.pool.timeout):
+                    break
+
+    def read(self):
+        with self._condition:
+            if len(self._packets) < self.low_water and not self._requested and not self._ended:
+                self._request(self.batch)
+            if not self._packets and not self._ended:
+                self._condition.wait(discord.opus.Encoder.FRAME_LENGTH/1000)
+            if self._packets:
+                return self._packets.popleft()
+            return b"" if self._ended else SILENCE
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.worker.close_stream(self)
+
+    def _feed(self, packets: list[bytes]):
+        with self._condition:
+            self._packets.extend(packets)
+            self._requested = False
+            self._condition.notify_all()
+
+    def _end(self, error: Optional[str]):
+        with self._condition:
+            self.error = error
+            self._ended = True
+            self._condition.notify_all()
+        if error:
+            print_error("Voice Worker Error", error, stream=self.stream_id)
+
+
+class _Worker:
+    "A worker process along with the thread reading its replies"
+    def __init__(self, pool: "VoiceWorkerPool", context):
+        self.pool = pool
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.streams: dict[int, WorkerAudio] = {}
+        self.alive = True
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, name="voice-worker-reader", daemon=True)
+        self._reader.start()
+
+    def send(self, op: int, stream_id: int, payload: bytes = b""):
+        with self._lock:
+            try:
+                self.conn.send_bytes(HEADER.pack(op, stream_id)+payload)
+            except OSError:
+                self.alive = False
+
+    def close_stream(self, audio: WorkerAudio):
+        if self.streams.pop(audio.stream_id, None) is not None:
+            self.send(CLOSE, audio.stream_id)
+
+    def _read(self):
+        while True:
+            try:
+                message = memoryview(self.conn.recv_bytes())
+            except (EOFError, OSError):
+                break
+            op, stream_id = HEADER.unpack_from(message)
+            audio = self.streams.get(stream_id)
+            if audio is None:
+                continue
+            if op == PACKETS:
+                audio._feed(_decode_packets(message[HEADER.size:]))
+            elif op == END:
+                audio._end(bytes(message[HEADER.size:]).decode() or None)
+        self.alive = False
+        for audio in list(self.streams.values()):
+            audio._end("The voice worker exited.")
+
+    def stop(self):
+        self.alive = False
+        self.conn.close()
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class VoiceWorkerPool:
+    """Decodes, scales and encodes audio for many guilds in `workers` processes.
+
+    The voice clients stay in the bot process, their audio players only
+    send the opus packets the workers hand over, so encoding no longer
+    competes with the event loop for the GIL. Streams go to the worker
+    serving the fewest, workers which died are replaced on the next `open`.
+    """
+    def __init__(self, workers: int = 2, timeout: float = 10):
+        self.workers = workers
+        self.timeout = timeout
+        self._workers: list[_Worker] = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def configure(self, *, workers: Optional[int] = None, timeout: Optional[float] = None):
+        if workers is not None:
+            self.workers = workers
+        if timeout is not None:
+            self.timeout = timeout
+
+    @property
+    def streams(self):
+        return sum(len(worker.streams) for worker in self._workers)
+
+    def start(self):
+        "Starts missing workers, they take a moment to load before serving their first stream"
+        with self._lock:
+            self._workers = [worker for worker in self._workers if worker.alive]
+            while len(self._workers) < self.workers:
+                self._workers.append(_Worker(self, multiprocessing.get_context("spawn")))
+
+    def open(self, location: str, *, before_options: str, options: str, volume: float = 1.0):
+        "Starts decoding location in a worker, returns the audio source playing it"
+        self.start()
+        with self._lock:
+            worker = min(self._workers, key=lambda worker: len(worker.streams))
+            stream_id = next(self._ids)
+        audio = WorkerAudio(worker, stream_id, volume)
+        worker.streams[stream_id] = audio
+        worker.send(OPEN, stream_id, json.dumps({"location": location, "before_options": before_options, "options": options, "volume": volume}).encode())
+        return audio
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Optional
+
+from utils import metrics
+
+
+# Call sites in files under this directory are the bot's own code
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _describe(frame: FrameType, filename: str):
+    return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+
+def call_site(frame: FrameType):
+    """Names where a stack is, by its innermost frame of the bot's own code.
+
+    The innermost frame is added when it is elsewhere, a library call blocking
+    the loop is mostly worth knowing along with the line that made it.
+    """
+    innermost = frame
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(ROOT) and filename != __file__:
+            break
+        frame = frame.f_back
+    described = _describe(innermost, os.path.basename(innermost.f_code.co_filename))
+    if frame is None:
+        return described
+    site = _describe(frame, os.path.relpath(frame.f_code.co_filename, ROOT))
+    return site if frame is innermost else f"{site} -> {described}"
+
+
+class LoopWatchdog:
+    """Samples the stack of the event loop's thread while the loop is blocked.
+
+    The loop beats every `interval` seconds, how late each beat comes is
+    the loop lag metric. A helper thread checks the beat
+    every `sample_interval` seconds, and once it is `threshold` seconds
+    overdue records the call site the loop thread is at. Blocks are printed
+    when they end, and the time spent blocked is summed up per call site,
+    keeping the `max_sites` worst.
+    """
+    def __init__(self, printer=None, threshold: float = 0.1, interval: float = 0.02, sample_interval: float = 0.01, max_sites: int = 256):
+        self.printer = printer
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.max_sites = max_sites
+        self.blocks = 0
+        # Call site: [samples, blocks it was the main site of, longest of those blocks]
+        self._sites: dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._beat_handle: Optional[asyncio.TimerHandle] = None
+        self._last_beat = 0.0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        "Starts watching the running loop, call it from the loop's thread"
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self._last_beat = 0.0
+        self._beat()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._beat_handle is not None:
+            self._beat_handle.cancel()
+            self._beat_handle = None
+
+    def worst(self, count: int = 10):
+        "The call sites the loop was blocked at the longest, as (site, seconds blocked, blocks, longest block)"
+        with self._lock:
+            sites = [(site, samples*self.sample_interval, blocks, longest) for site, (samples, blocks, longest) in self._sites.items()]
+        return sorted(sites, key=lambda site: site[1], reverse=True)[:count]
+
+    def _beat(self):
+        now = time.perf_counter()
+        if self._last_beat:
+            metrics.loop_lag_seconds.observe(max(now-self._last_beat-self.interval, 0.0))
+        self._last_beat = now
+        self._beat_handle = self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        blocked_since = None
+        samples: dict[str, int] = {}
+        while not self._stopped.wait(self.sample_interval):
+            last_beat = self._last_beat
+            # The loop beat again since the block began, so the block is over
+            if blocked_since is not None and last_beat != blocked_since:
+                self._record(samples, last_beat-blocked_since-self.interval)
+                blocked_since, samples = None, {}
+            if time.perf_counter()-last_beat-self.interval < self.threshold:
+                continue
+            blocked_since = last_beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                site = call_site(frame)
+                samples[site] = samples.get(site, 0)+1
+            del frame
+
+    def _record(self, samples: dict[str, int], duration: float):
+        self.blocks += 1
+        metrics.loop_block_seconds.observe(duration)
+        main_site = max(samples, key=samples.get) if samples else "unknown"
+        with self._lock:
+            for site, count in samples.items():
+                record = self._sites.setdefault(site, [0, 0, 0.0])
+                record[0] += count
+            if main_site in self._sites:
+                record = self._sites[main_site]
+                record[1] += 1
+                record[2] = max(record[2], duration)
+            if len(self._sites) > self.max_sites:
+                del self._sites[min(self._sites, key=lambda site: self._sites[site][0])]
+        if self.printer is not None:
+            self.printer.print_info("Event Loop Blocked", {"duration": f"{duration*1000:.0f}ms", "call site": main_site, "samples": sum(samples.values())})